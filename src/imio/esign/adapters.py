@@ -1,4 +1,9 @@
-from imio.esign.browser.views import DUMMY_SESSIONS
+from imio.esign.interfaces import IEsignContext
+from imio.esign.interfaces import IEsignFile
+from imio.esign.utils import get_readonly_session_annotation
+from imio.esign.utils import get_request_session
+from plone.indexer import indexer
+from plone.uuid.interfaces import IUUID
 
 
 class DefaultContextUidProvider(object):
@@ -26,15 +31,44 @@ class FilesBelongingToAGivenSession(object):
             session_id = self.request.form["esign_session_id[]"]
         else:
             session_id = self.request.get("esign_session_id", None)
-        if not session_id:
+        try:
+            session_id = int(session_id)
+        except (TypeError, ValueError):
             return {"UID": {"query": []}}
-        session = self.get_session(session_id)
-        obj_uids = []
-        for f in session.get("files", []):
-            obj_uids.append(f["context_uid"])
-        return {"UID": {"query": obj_uids}}
+        return {"esign_session_ids": {"query": [session_id]}}
 
     def get_session(self, session_id):
-        return DUMMY_SESSIONS["sessions"].get(int(session_id), {})
+        return get_request_session(session_id, self.request) or {}
 
     query = query_session_files
+
+
+@indexer(IEsignFile)
+def esign_session_ids(obj):
+    """Index the ids of the sessions containing a file."""
+    return _get_session_ids(obj)
+
+
+@indexer(IEsignContext)
+def context_esign_session_ids(obj):
+    """Index the ids of the sessions containing files of a context."""
+    return _get_session_ids(obj)
+
+
+def _get_session_ids(obj):
+    """Get the ids of the sessions containing an annex or files of a context.
+
+    Nothing is indexed for an object that is not in a session.
+    """
+    uid = IUUID(obj, None)
+    if uid is None:
+        raise AttributeError
+    annot = get_readonly_session_annotation()
+    session_ids = set()
+    for file_uid in [uid] + list(annot["c_uids"].get(uid, ())):
+        session_id = annot["uids"].get(file_uid)
+        if session_id is not None:
+            session_ids.add(session_id)
+    if not session_ids:
+        raise AttributeError
+    return sorted(session_ids)
@@ -1,23 +1,37 @@
 # -*- coding: utf-8 -*-
 from DateTime import DateTime
 from imio.esign import _
+from plone import api
+from plone.memoize import ram
 from Products.CMFPlone.utils import safe_unicode
 from z3c.table.column import Column
 from z3c.table.table import Table
 from zope.i18n import translate
 
 
-class IdColumn(Column):
+class SortableColumn(Column):
+    """Column whose header links to the listing sorted on its "sort_on" key."""
+
+    sort_on = None
+
+    def renderHeadCell(self):
+        header = super(SortableColumn, self).renderHeadCell()
+        return u'<a href="{}">{}</a>'.format(self.table.view.get_sort_url(self.sort_on), header)
+
+
+class IdColumn(SortableColumn):
     header = _("ID")
     weight = 10
+    sort_on = "id"
 
     def renderCell(self, item):
         return str(item.get("id", ""))
 
 
-class StateColumn(Column):
+class StateColumn(SortableColumn):
     header = _("State")
     weight = 20
+    sort_on = "state"
 
     def renderCell(self, item):
         return translate(
@@ -33,9 +47,10 @@ class TitleColumn(Column):
         return safe_unicode(item.get("title", ""))
 
 
-class LastUpdateColumn(Column):
+class LastUpdateColumn(SortableColumn):
     header = _("Last update")
     weight = 40
+    sort_on = "last_update"
 
     def renderCell(self, item):
         last_update = item.get("last_update")
@@ -49,7 +64,7 @@ class SignersColumn(Column):
     def renderCell(self, item):
         signers = item.get("signers") or []
         parts = [
-            "<li>%s, %s (%s)</li>" % (s.get("fullname", ""), s.get("held_position"), s.get("status", ""))
+            "<li>%s, %s (%s)</li>" % (s.get("fullname", ""), s.get("position"), s.get("status", ""))
             for s in signers
         ]
         return "<ol>%s</ol>" % "".join(parts)
@@ -109,6 +124,18 @@ class ActionsColumn(Column):
         """
 
 
+def _row_cells_cachekey(method, self, row):
+    """Cache rendered cells per session version, language, user (dashboard link) and site."""
+    item = row[0][0]
+    return (
+        item["id"],
+        item["last_update"],
+        api.portal.get_current_language(),
+        api.user.get_current().getId(),
+        self.portal_url,
+    )
+
+
 class SessionsTable(Table):
     cssClassEven = "even"
     cssClassOdd = "odd"
@@ -120,6 +147,7 @@ class SessionsTable(Table):
         super(SessionsTable, self).__init__(context, request)
         self.view = view
         self._items = items
+        self.portal_url = api.portal.get().absolute_url()
 
     @property
     def values(self):
@@ -136,3 +164,11 @@ class SessionsTable(Table):
             FilesColumn(ctx, req, tbl),
             ActionsColumn(ctx, req, tbl),
         ]
+
+    def renderRow(self, row, cssClass=None):
+        return "\n    <tr{}>{}\n    </tr>".format(self.getCSSClass("tr", cssClass), self.renderRowCells(row))
+
+    @ram.cache(_row_cells_cachekey)
+    def renderRowCells(self, row):
+        """Render the cells of a session row, cached until the session is updated."""
+        return "".join([self.renderCell(item, column, colspan) for item, column, colspan in row])
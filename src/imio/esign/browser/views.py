@@ -1,128 +1,85 @@
 # -*- coding: utf-8 -*-
 from imio.esign.browser.table import SessionsTable
-from imio.helpers.content import uuidToObject
-from imio.prettylink.interfaces import IPrettyLink
+from imio.esign.inbox import process_feedback_inbox
+from imio.esign.outbox import dispatch_pending_sessions
+from imio.esign.retrieval import retrieve_pending_sessions
+from imio.esign.utils import BatchItems
+from imio.esign.utils import get_readonly_session_annotation
+from imio.esign.utils import get_request_session
+from imio.esign.utils import get_sessions_batch
+from imio.esign.utils import SESSIONS_SORT_ON
+from imio.helpers.content import uuidsToCatalogBrains
 from plone import api
 from plone.app.layout.viewlets import ViewletBase
+from plone.batching import Batch
+from plone.memoize import ram
+from Products.CMFPlone.utils import safe_unicode
 from Products.Five import BrowserView
+from xml.sax.saxutils import escape
 from zope.browserpage.viewpagetemplatefile import ViewPageTemplateFile
+from zope.i18n import translate
+from ZTUtils import make_query
 
-import datetime
-
-
-DUMMY_SESSIONS = {
-    "numbering": 1,
-    "uids": {"78e72614568f4e8cb74a7fda90f89ad1": 0},
-    "sessions": {
-        25452: {
-            "id": 25452,
-            "files": [
-                {
-                    "scan_id": "012345600000001",
-                    "title": "Annex 1",
-                    "uid": "78e72614568f4e8cb74a7fda90f89ad1",
-                    "context_uid": "c65197e2bab64ceab88c405dc0296cfa",
-                    "filename": "annex1.pdf",
-                }
-            ],
-            "title": "Séance du Collège du 13/08/2025 (18:00) - 1",
-            "signers": [
-                {
-                    "status": "pending",
-                    "userid": "user1",
-                    "fullname": "Jean Dupont",
-                    "held_position": u"Directeur Général",
-                    "email": "user1@sign.com",
-                },
-                {
-                    "status": "signed",
-                    "userid": "user2",
-                    "fullname": "Jeanne Dupont",
-                    "held_position": u"Bourgmestre",
-                    "email": "user2@sign.com",
-                },
-            ],
-            "last_update": datetime.datetime(2025, 8, 13, 10, 44, 1, 419579),
-            "state": "draft",
-            "seal": False,
-        },
-        25453: {
-            "id": 25453,
-            "files": [
-                {
-                    "scan_id": "012345600000001",
-                    "title": "Annex 1",
-                    "uid": "78e72614568f4e8cb74a7fda90f89ad1",
-                    "context_uid": "c65197e2bab64ceab88c405dc0296cfa",
-                    "filename": "annex1.pdf",
-                }
-            ],
-            "title": "Séance du Collège du 18/08/2025 (18:00) - 1",
-            "signers": [
-                {
-                    "status": "pending",
-                    "userid": "user1",
-                    "fullname": "Jean Dupont",
-                    "held_position": u"Directeur Général",
-                    "email": "user1@sign.com",
-                },
-                {
-                    "status": "signed",
-                    "userid": "user2",
-                    "fullname": "Jeanne Dupont",
-                    "held_position": u"Bourgmestre",
-                    "email": "user2@sign.com",
-                },
-            ],
-            "last_update": datetime.datetime(2025, 8, 13, 10, 44, 1, 419579),
-            "state": "draft",
-            "seal": False,
-        },
-        25454: {
-            "id": 25454,
-            "files": [
-                {
-                    "scan_id": "012345600000001",
-                    "title": "Annex 1",
-                    "uid": "78e72614568f4e8cb74a7fda90f89ad1",
-                    "context_uid": "c65197e2bab64ceab88c405dc0296cfa",
-                    "filename": "annex1.pdf",
-                }
-            ],
-            "title": "Séance du Collège du 18/08/2025 (18:00) - 2",
-            "signers": [
-                {
-                    "status": "pending",
-                    "userid": "user1",
-                    "fullname": "Jean Dupont",
-                    "held_position": u"Directeur Général",
-                    "email": "user1@sign.com",
-                },
-                {
-                    "status": "signed",
-                    "userid": "user2",
-                    "fullname": "Jeanne Dupont",
-                    "held_position": u"Bourgmestre",
-                    "email": "user2@sign.com",
-                },
-            ],
-            "last_update": datetime.datetime(2025, 8, 13, 10, 44, 1, 419579),
-            "state": "draft",
-            "seal": False,
-        },
-    },
-}
+
+class DispatchSessionsView(BrowserView):
+    """Send the pending sessions of the outbox, as called by a clock server or a cron."""
+
+    def __call__(self):
+        portal = api.portal.get()
+        results = dispatch_pending_sessions(portal._p_jar.db(), portal.getPhysicalPath())
+        sent = len([session_id for session_id, result in results.items() if result])
+        self.request.response.setHeader("Content-Type", "text/plain")
+        return "Sent sessions: {}, failed: {}".format(sent, len(results) - sent)
+
+
+class ProcessFeedbacksView(BrowserView):
+    """Apply the feedbacks of the inbox on their sessions, as called by a clock server or a cron."""
+
+    def __call__(self):
+        portal = api.portal.get()
+        applied = process_feedback_inbox(portal._p_jar.db(), portal.getPhysicalPath())
+        self.request.response.setHeader("Content-Type", "text/plain")
+        return "Applied feedbacks: {}".format(applied)
+
+
+class RetrieveSignedFilesView(BrowserView):
+    """Retrieve the signed files of the sessions to upload, as called by a clock server or a cron."""
+
+    def __call__(self):
+        portal = api.portal.get()
+        results = retrieve_pending_sessions(portal._p_jar.db(), portal.getPhysicalPath())
+        done = len([session_id for session_id, remaining in results.items() if not remaining])
+        self.request.response.setHeader("Content-Type", "text/plain")
+        return "Retrieved sessions: {}, incomplete: {}".format(done, len(results) - done)
 
 
 class SessionsListingView(BrowserView):
-    """View to list sessions."""
+    """View to list sessions, batched, sorted and filtered on the server side.
+
+    Request parameters: "b_start", "b_size", "sort_on" (last_update, id or state), "sort_order" (reverse) and
+    "state".
+    """
 
     index = ViewPageTemplateFile("templates/sessions.pt")
+    b_size = 20
 
     def __init__(self, context, request):
         super(SessionsListingView, self).__init__(context, request)
+        self.batch = None
+        self.sessions = []
 
     def __call__(self):
+        form = self.request.form
+        self.b_start = _to_int(form.get("b_start"), 0)
+        self.b_size = _to_int(form.get("b_size"), self.b_size) or self.b_size
+        self.sort_on = form["sort_on"] if form.get("sort_on") in SESSIONS_SORT_ON else "last_update"
+        self.reverse = form.get("sort_order") in ("reverse", "descending")
+        self.state = form.get("state") or None
+        total, sessions = get_sessions_batch(
+            b_start=self.b_start, b_size=self.b_size, sort_on=self.sort_on, reverse=self.reverse, state=self.state
+        )
+        self.sessions = [dict(session.items(), id=session_id) for session_id, session in sessions]
+        self.batch = Batch(BatchItems(self.sessions, total), self.b_size, self.b_start)
         return self.index()
 
     def render_table(self):
@@ -131,7 +88,22 @@ class SessionsListingView(BrowserView):
         return table.render()
 
     def get_sessions(self):
-        return DUMMY_SESSIONS["sessions"].values()
+        """Get the sessions of the current batch, as dicts with their "id"."""
+        return self.sessions
+
+    def get_sort_url(self, sort_on):
+        """Get the listing URL sorted on the given key, in reverse order if it is already sorted on it."""
+        query = {"sort_on": sort_on, "b_size": self.b_size}
+        if sort_on == self.sort_on and not self.reverse:
+            query["sort_order"] = "reverse"
+        if self.state:
+            query["state"] = self.state
+        return "{}/@@esign-sessions-listing?{}".format(self.context.absolute_url(), make_query(query))
+
+    def get_states(self):
+        """Get the used states, with their number of sessions."""
+        states = get_readonly_session_annotation()["states"]
+        return [(state, len(session_ids)) for state, session_ids in states.items() if session_ids]
 
     def get_dashboard_link(self, session):
         user_id = api.user.get_current().getId()
@@ -143,36 +115,85 @@ class SessionsListingView(BrowserView):
 
 
 class SessionFilesView(BrowserView):
-    """View to display documents of a session."""
+    """View to display documents of a session, batched.
+
+    Files and their contexts are resolved with one catalog query and their links are rendered from the brains
+    metadata, without waking up the objects.
+    """
 
     index = ViewPageTemplateFile("templates/session_files.pt")
+    b_size = 50
 
     def __init__(self, context, request):
         super(SessionFilesView, self).__init__(context, request)
+        self.batch = None
         self.files = []
+        self._type_icons = {}
 
     def __call__(self):
-        session_id = self.request.get("session_id")
-        session = self.get_session(session_id)
-        files = []
-        for f in session["files"]:
-            ctx = uuidToObject(f["context_uid"])
-            obj = uuidToObject(f["uid"])
-            if obj and ctx:
-                files.append((ctx, obj))
-        self.files = files
+        session = self.get_session(self.request.get("session_id"))
+        session_files = session["files"] if session else []
+        b_start = _to_int(self.request.get("b_start"), 0)
+        b_size = _to_int(self.request.get("b_size"), self.b_size) or self.b_size
+        b_end = b_start + b_size
+        page = list(session_files[b_start:b_end])
+        uids = [uid for session_file in page for uid in (session_file["context_uid"], session_file["uid"])]
+        brains = {brain.UID: brain for brain in uuidsToCatalogBrains(uuids=uids)}
+        self.files = [
+            (brains[session_file["context_uid"]], brains[session_file["uid"]])
+            for session_file in page
+            if session_file["context_uid"] in brains and session_file["uid"] in brains
+        ]
+        self.batch = Batch(BatchItems(self.files, len(session_files)), b_size, b_start)
         return self.index()
 
     def get_session(self, session_id):
-        """Get the session object."""
-        return filter(lambda s: s["id"] == int(session_id), DUMMY_SESSIONS["sessions"].values())[0]
+        """Get the stored session."""
+        return get_request_session(session_id, self.request)
 
     def get_file_link(self, ctx, obj):
-        return IPrettyLink(ctx).getLink() + " / " + IPrettyLink(obj).getLink()
+        """Get the links to the context and to the file download, from their catalog brains."""
+        return self.get_brain_link(ctx) + " / " + self.get_brain_link(obj, url=obj.getURL() + "/@@download")
+
+    def get_brain_link(self, brain, url=None):
+        """Render a link like IPrettyLink does, from the brain metadata."""
+        title = escape(safe_unicode(brain.Title), {"'": "&apos;"})
+        icon = self._get_type_icon(brain.portal_type)
+        state = u" state-{}".format(brain.review_state) if brain.review_state else u""
+        return (
+            u"<a class='pretty_link' title='{0}' href='{1}' target='_self'>{2}"
+            u"<span class='pretty_link_content{3}'>{0}</span></a>".format(title, url or brain.getURL(), icon, state)
+        )
+
+    def _get_type_icon(self, portal_type):
+        """Get the content icon tag of a portal type, computed once per type."""
+        if portal_type not in self._type_icons:
+            icon = u""
+            type_info = api.portal.get_tool("portal_types").getTypeInfo(portal_type)
+            if type_info is not None and type_info.icon_expr:
+                # icon_expr is like string:${portal_url}/icon.png
+                icon = u"<span class='pretty_link_icons'><img title='{0}' src='{1}/{2}' /></span>".format(
+                    escape(safe_unicode(translate(type_info.Title(), context=self.request)), {"'": "&apos;"}),
+                    api.portal.get().absolute_url(),
+                    "/".join(type_info.icon_expr.split("/")[1:]),
+                )
+            self._type_icons[portal_type] = icon
+        return self._type_icons[portal_type]
+
+
+def _session_info_cachekey(method, self):
+    """Cache the session information per session version, language and site."""
+    if self.session is None:
+        raise ram.DontCache
+    return self.session_id, self.session["last_update"], api.portal.get_current_language(), self.site_url
 
 
 class FacetedSessionSessionInfoViewlet(ViewletBase):
-    """Show selected session info inside faceted results."""
+    """Show selected session info inside faceted results.
+
+    The faceted results are refreshed with ajax requests, so the rendered information is cached until the session
+    is updated.
+    """
 
     # Put the template in your package under: imio/esign/browser/templates/faceted_session_info.pt
     index = ViewPageTemplateFile("templates/faceted_session_info.pt")
@@ -184,18 +205,28 @@ class FacetedSessionSessionInfoViewlet(ViewletBase):
 
     def update(self):
         super(FacetedSessionSessionInfoViewlet, self).update()
-        self.session = None
+        self.session_id = self.session = None
         if "esign_session_id[]" in self.request.form.keys():
             session_id = self.request.form["esign_session_id[]"]
         else:
             session_id = self.request.get("esign_session_id", None)
-        if not session_id:
+        session = get_request_session(session_id, self.request)
+        if session is None:
             return
-        data = DUMMY_SESSIONS.get("sessions", {})
-        sess = data.get(int(session_id))
-        if not sess:
-            return
-        self.session = sess
+        self.session_id = int(session_id)
+        self.session = session
 
     def has_session(self):
         return bool(self.session)
+
+    @ram.cache(_session_info_cachekey)
+    def render(self):
+        return self.index()
+
+
+def _to_int(value, default):
+    """Convert a request value to int."""
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return default
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Pooled http client used to call the esign service.
+
+Its settings can be overridden by environment variables:
+
+* IMIO_ESIGN_CONNECT_TIMEOUT: connect timeout in seconds (default 5)
+* IMIO_ESIGN_READ_TIMEOUT: read timeout in seconds (default 120)
+* IMIO_ESIGN_RETRIES: retries on connection errors, and on 502, 503, 504 responses of idempotent requests (default 3)
+* IMIO_ESIGN_BACKOFF_FACTOR: retries backoff factor in seconds (default 0.5)
+* IMIO_ESIGN_POOL_CONNECTIONS: number of pooled hosts (default 4)
+* IMIO_ESIGN_POOL_MAXSIZE: maximum kept alive connections per host (default 10)
+"""
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import os
+import requests
+import threading
+
+
+DEFAULTS = {
+    "connect_timeout": 5.0,
+    "read_timeout": 120.0,
+    "retries": 3,
+    "backoff_factor": 0.5,
+    "pool_connections": 4,
+    "pool_maxsize": 10,
+}
+RETRY_STATUSES = (502, 503, 504)
+
+_lock = threading.Lock()
+_session = None
+
+
+def get_http_settings():
+    """Get the http client settings, from environment variables or defaults.
+
+    :return: dict of settings
+    """
+    settings = {}
+    for key, default in DEFAULTS.items():
+        value = os.getenv("IMIO_ESIGN_{}".format(key.upper()))
+        settings[key] = default if value is None else type(default)(value)
+    return settings
+
+
+def get_http_session():
+    """Get the module level requests session, created at first call.
+
+    Its connections are kept alive and reused by all threads.
+    Only connection errors are retried for a POST, because a request may have been received.
+
+    :return: requests Session
+    """
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                settings = get_http_settings()
+                retry = Retry(
+                    total=settings["retries"],
+                    backoff_factor=settings["backoff_factor"],
+                    status_forcelist=RETRY_STATUSES,
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=settings["pool_connections"],
+                    pool_maxsize=settings["pool_maxsize"],
+                    max_retries=retry,
+                )
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def get_timeout():
+    """Get the (connect, read) requests timeout."""
+    settings = get_http_settings()
+    return settings["connect_timeout"], settings["read_timeout"]
+
+
+def reset_http_session():
+    """Close the module level session, a new one will be created with current settings."""
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = None
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""Inbox of the external sessions feedbacks.
+
+A received feedback is only appended to the inbox, keyed by its reception datetime and its code, and its code
+is registered to ignore duplicate deliveries, during the number of days given by the IMIO_ESIGN_FEEDBACK_CODES_DAYS
+environment variable (default 30). Concurrent feedbacks insert different keys, which are merged by
+the BTrees conflict resolution, and never write the sessions edited by users.
+An applier then folds the inbox into the sessions, in a thread after commit or periodically, with short
+transactions retried on conflict.
+Signing events of a feedback update the status of their signer and are kept in the session events log.
+A session set in the "to_upload" state is registered to retrieve its signed files, after the inbox is applied.
+"""
+from BTrees.OOBTree import OOTreeSet
+from datetime import datetime
+from datetime import timedelta
+from imio.esign.retrieval import start_retrieval
+from imio.esign.transactions import in_transaction
+from imio.esign.transactions import site_connection
+from imio.esign.utils import get_readonly_session_annotation
+from imio.esign.utils import get_session_annotation
+from imio.esign.utils import get_session_id_from_app_session_id
+from imio.esign.utils import index_session
+from plone import api
+from ZODB.POSException import ConflictError
+
+import logging
+import os
+import threading
+import transaction
+
+
+logger = logging.getLogger("imio.esign")
+APPLY_BATCH_SIZE = 100
+FEEDBACK_CODES_DAYS = int(os.getenv("IMIO_ESIGN_FEEDBACK_CODES_DAYS", 30))
+# esign service event code -> (event name, new signer status or None)
+SIGNER_EVENTS = {
+    6: ("SIGNATURE_SIGNED", "signed"),
+    7: ("DOCUMENT_DECLINED", "declined"),
+    8: ("DOCUMENT_REINSTATE", "pending"),
+    10: ("STEP_DECLINED", "declined"),
+    18: ("STEP_COMMENT_ADDED", None),
+    24: ("STEP_SUSPENDED", "suspended"),
+    25: ("STEP_RESUMED", "pending"),
+    26: ("STEP_CANCELED", "canceled"),
+}
+
+_applier_lock = threading.Lock()
+_applier_requested = threading.Event()
+
+
+def apply_feedback_inbox(annot=None, limit=None):
+    """Apply the inbox feedbacks on their sessions, in reception order, and remove them from the inbox.
+
+    :param annot: esign annotation, if not provided it will be fetched
+    :param limit: maximum number of feedbacks to apply
+    :return: number of applied feedbacks
+    """
+    if not annot:
+        annot = get_session_annotation()
+    inbox = annot["inbox"]
+    keys = list(inbox.keys()[:limit] if limit else inbox.keys())
+    for key in keys:
+        status, message = apply_session_feedback(inbox[key], annot, received=key[0])
+        if status != 200:
+            logger.error("Feedback %s not applied: %s", key[1], message)
+        del inbox[key]
+    return len(keys)
+
+
+def apply_session_feedback(data, annot, received=None):
+    """Apply a feedback on its session.
+
+    :param data: feedback dict, as described in ExternalSessionFeedbackPost
+    :param annot: esign annotation
+    :param received: reception datetime of the feedback, now by default
+    :return: (http status, message)
+    """
+    status, message = check_feedback(data, annot)
+    if status != 200:
+        return status, message
+    try:
+        session_id = get_session_id_from_app_session_id(data["app_session_id"], annot=annot)
+        session = annot["sessions"][session_id]
+        if received is None:
+            received = datetime.now()
+        session_update = {}
+        session_state = data.get("session_state")
+        if session_state and session_state != session["state"]:
+            session_update["state"] = session_state
+            if session_state == "to_upload" and session_id not in annot["retrievals"]:
+                annot["retrievals"][session_id] = OOTreeSet()
+        sign_url = data.get("sign_url")
+        if sign_url:
+            session_update["sign_url"] = sign_url
+        events = data.get("events") or []
+        for event in events:
+            apply_signer_event(session, event, received)
+        if session_update or events:
+            session.update(session_update)
+            session["last_update"] = datetime.now()
+            index_session(session_id, session, annot=annot)
+    except ConflictError:
+        raise
+    except Exception as e:
+        return 500, str(e)
+    return 200, "Information correctly handled"
+
+
+def apply_signer_event(session, event, received):
+    """Apply a signing event on the status of its signer and add it to the session events log.
+
+    :param session: Session
+    :param event: event dict, with "event" code, "signer" userid or email and optional "message"
+    :param received: reception datetime of the event
+    """
+    code = event.get("event")
+    signer_key = event.get("signer")
+    session.add_event((received, code, signer_key, event.get("message")))
+    name, signer_status = SIGNER_EVENTS.get(code, (None, None))
+    if name is None:
+        logger.warning("Unknown event %s received for signer %s", code, signer_key)
+        return
+    if signer_status is None:
+        return
+    signer = signer_key and session.get_signer(signer_key)
+    if not signer:
+        logger.warning("Event %s received for unknown signer %s", name, signer_key)
+        return
+    if signer["status"] != signer_status:
+        signer["status"] = signer_status
+        session["signers"]._p_changed = True
+
+
+def check_feedback(data, annot):
+    """Check a feedback without writing anything.
+
+    :param data: feedback dict
+    :param annot: esign annotation
+    :return: (http status, message)
+    """
+    app_session_id = data.get("app_session_id")
+    if not app_session_id:
+        return 400, "app_session_id is required"
+    code = data.get("code")
+    if not code:
+        return 400, "code is required"
+    events = data.get("events")
+    if events is not None and (not isinstance(events, list) or not all(isinstance(event, dict) for event in events)):
+        return 400, "events must be a list of objects"
+    if get_session_id_from_app_session_id(app_session_id, annot=annot) is None:
+        return 400, "Session {} not found".format(app_session_id)
+    return 200, ""
+
+
+def enqueue_feedback(data, annot=None):
+    """Append a feedback to the inbox, unless its code has already been received.
+
+    The inbox is applied after the transaction commit. An invalid feedback is rejected without writing anything.
+    The codes received more than FEEDBACK_CODES_DAYS days ago are forgotten.
+
+    :param data: feedback dict
+    :param annot: esign annotation, if not provided it will be fetched
+    :return: (http status, message)
+    """
+    status, message = check_feedback(data, annot or get_readonly_session_annotation())
+    if status != 200:
+        return status, message
+    if not annot:
+        annot = get_session_annotation()
+    key = (datetime.now(), data["code"])
+    _prune_feedback_codes(annot, key[0] - timedelta(days=FEEDBACK_CODES_DAYS))
+    if key[1] in annot["feedback_codes"]:
+        return 200, "Information already handled"
+    annot["inbox"][key] = dict(data)
+    annot["feedback_codes"][key[1]] = key[0]
+    annot["feedback_receptions"].insert(key)
+    _request_applier()
+    return 200, "Information correctly handled"
+
+
+def process_feedback_inbox(db, portal_path, batch_size=APPLY_BATCH_SIZE):
+    """Apply all the inbox feedbacks, with a new connection to the database, in short transactions.
+
+    :param db: ZODB database
+    :param portal_path: portal physical path
+    :param batch_size: number of feedbacks applied per transaction
+    :return: number of applied feedbacks
+    """
+    applied = 0
+    with site_connection(db, portal_path) as tm:
+        while True:
+            count = in_transaction(tm, apply_feedback_inbox, batch_size)
+            applied += count
+            if count < batch_size:
+                return applied
+
+
+def _apply_after_commit(status, db, portal_path):
+    """After commit hook starting the applier thread, unless it is already running in this process."""
+    if not status:
+        return
+    _applier_requested.set()
+    if not _applier_lock.acquire(False):
+        # the running applier will run again
+        return
+    thread = threading.Thread(target=_run_applier, args=(db, portal_path), name="imio.esign-feedbacks")
+    thread.start()
+
+
+def _prune_feedback_codes(annot, before):
+    """Forget the feedback codes received before the given datetime, oldest first."""
+    for received, code in list(annot["feedback_receptions"].keys(max=(before,))):
+        annot["feedback_receptions"].remove((received, code))
+        if annot["feedback_codes"].get(code) == received:
+            del annot["feedback_codes"][code]
+
+
+def _request_applier():
+    """Register the after commit hook applying the inbox, once per transaction."""
+    txn = transaction.get()
+    for hook, args, kwargs in txn.getAfterCommitHooks():
+        if hook is _apply_after_commit:
+            return
+    portal = api.portal.get()
+    txn.addAfterCommitHook(_apply_after_commit, args=(portal._p_jar.db(), portal.getPhysicalPath()))
+
+
+def _run_applier(db, portal_path):
+    """Apply the inbox while it is requested. The applier lock is acquired by the caller."""
+    while True:
+        try:
+            while _applier_requested.is_set():
+                _applier_requested.clear()
+                try:
+                    if process_feedback_inbox(db, portal_path):
+                        start_retrieval(db, portal_path)
+                except Exception:
+                    logger.exception("Error while applying feedbacks")
+        finally:
+            _applier_lock.release()
+        # a request may have been done just before the release
+        if not _applier_requested.is_set() or not _applier_lock.acquire(False):
+            return
@@ -9,6 +9,14 @@ class IImioEsignLayer(IDefaultBrowserLayer):
     """Marker interface that defines a browser layer."""
 
 
+class IEsignContext(Interface):
+    """Marker interface of a context of files added to esign sessions."""
+
+
+class IEsignFile(Interface):
+    """Marker interface of a file added to esign sessions."""
+
+
 class IContextUidProvider(Interface):
     """Adapter to provide context UID for a file."""
 
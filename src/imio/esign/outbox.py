@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""Outbox of the external sessions to create.
+
+Queuing a session only stores an outbox entry. The session is sent after the transaction commit, outside any
+user request, and its result is written in short transactions.
+Sessions are sent concurrently by a bounded pool of threads, each with its own database connection.
+The number of threads can be set with the IMIO_ESIGN_DISPATCH_WORKERS environment variable (default 4).
+
+Credentials are never stored in the outbox: they are given to the dispatch started after the commit, or read from
+the configuration (see utils.get_esign_settings) when pending sessions are dispatched later.
+An entry claimed by a dispatcher that never recorded its result, after a crash, can be claimed again when its claim
+is older than the IMIO_ESIGN_SENDING_TIMEOUT environment variable, in seconds (default 600). As a session is sent
+with its app session id as idempotency key, sending it again after a stale claim, for a slow upload or a result
+that could not be recorded, does not create a second external session.
+"""
+from datetime import datetime
+from datetime import timedelta
+from imio.esign.transactions import in_transaction
+from imio.esign.transactions import site_connection
+from imio.esign.utils import get_external_session_request
+from imio.esign.utils import get_feedback_endpoint_url
+from imio.esign.utils import get_readonly_session_annotation
+from imio.esign.utils import get_session_annotation
+from imio.esign.utils import index_session
+from imio.esign.utils import post_request
+from imio.esign.utils import register_app_session_id
+from imio.esign.utils import register_files_hashes
+from plone import api
+
+import logging
+import os
+import threading
+import transaction
+
+
+try:
+    from queue import Empty
+    from queue import Queue
+except ImportError:  # Python 2
+    from Queue import Empty
+    from Queue import Queue
+
+
+logger = logging.getLogger("imio.esign")
+DISPATCH_WORKERS = int(os.getenv("IMIO_ESIGN_DISPATCH_WORKERS", 4))
+QUEUEABLE_STATES = ("draft", "error")
+SENDING_TIMEOUT = int(os.getenv("IMIO_ESIGN_SENDING_TIMEOUT", 600))
+
+
+def dispatch_external_session(db, portal_path, session_id, b64_cred=None, esign_root_url=None):
+    """Send a queued session with a new connection to the database, as done in a thread.
+
+    :param db: ZODB database
+    :param portal_path: portal physical path
+    :param session_id: queued session id
+    :param b64_cred: base64 encoded credentials for authentication, if not provided the configured ones are used
+    :param esign_root_url: the root URL for the e-sign service, if not provided the configured one is used
+    :return: True if the session was sent
+    """
+    try:
+        with site_connection(db, portal_path) as tm:
+            return send_queued_session(session_id, tm=tm, b64_cred=b64_cred, esign_root_url=esign_root_url)
+    except Exception:
+        logger.exception("Error while dispatching session %s", session_id)
+        return False
+
+
+def dispatch_external_sessions(
+    db, portal_path, session_ids, b64_cred=None, esign_root_url=None, workers=DISPATCH_WORKERS
+):
+    """Send queued sessions concurrently, with a bounded number of threads.
+
+    :param db: ZODB database
+    :param portal_path: portal physical path
+    :param session_ids: queued session ids
+    :param b64_cred: base64 encoded credentials for authentication, if not provided the configured ones are used
+    :param esign_root_url: the root URL for the e-sign service, if not provided the configured one is used
+    :param workers: maximum number of threads
+    :return: dict session id -> True if sent
+    """
+    todo = Queue()
+    for session_id in session_ids:
+        todo.put(session_id)
+    results = {}
+
+    def worker():
+        while True:
+            try:
+                session_id = todo.get_nowait()
+            except Empty:
+                return
+            results[session_id] = dispatch_external_session(
+                db, portal_path, session_id, b64_cred=b64_cred, esign_root_url=esign_root_url
+            )
+
+    threads = [
+        threading.Thread(target=worker, name="imio.esign-dispatch-{}".format(i))
+        for i in range(min(workers, len(session_ids)))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def dispatch_pending_sessions(db, portal_path, workers=DISPATCH_WORKERS):
+    """Send all pending sessions of the outbox, as done by a clock server or a cron.
+
+    Entries whose claim is older than SENDING_TIMEOUT are sent again. Credentials are read from the configuration.
+
+    :param db: ZODB database
+    :param portal_path: portal physical path
+    :param workers: maximum number of threads
+    :return: dict session id -> True if sent
+    """
+    now = datetime.now()
+    with site_connection(db, portal_path):
+        outbox = get_readonly_session_annotation()["outbox"]
+        session_ids = [session_id for session_id, entry in outbox.items() if _is_claimable(entry, now)]
+    return dispatch_external_sessions(db, portal_path, session_ids, workers=workers)
+
+
+def queue_external_session(session_id, b64_cred=None, esign_root_url=None):
+    """Queue the creation of the external session, sent in a thread when the current transaction is committed.
+
+    The session state becomes "queued", so no file can be added anymore. It is sent only once: a session can be
+    queued again only after a failure.
+    The given credentials are only kept in memory, for the dispatch after the commit.
+
+    :param session_id: internal session id
+    :param b64_cred: base64 encoded credentials for authentication, if not provided the configured ones are used
+    :param esign_root_url: the root URL for the e-sign service, if not provided the configured one is used
+    :return: True if the session has been queued
+    """
+    annot = get_session_annotation()
+    session = annot["sessions"].get(session_id)
+    if not session:
+        logger.error("Session with id %s not found.", session_id)
+        return False
+    if session_id in annot["outbox"] or session["state"] not in QUEUEABLE_STATES:
+        logger.warning("Session with id %s is already queued or sent.", session_id)
+        return False
+    portal = api.portal.get()
+    annot["outbox"][session_id] = {
+        "claimed": None,
+        "endpoint_url": get_feedback_endpoint_url(portal),
+        "queued": datetime.now(),
+        "status": "pending",
+    }
+    register_app_session_id(session_id, annot=annot)
+    session["state"] = "queued"
+    session["last_update"] = datetime.now()
+    index_session(session_id, session, annot=annot)
+    _get_transaction_queue(portal, b64_cred, esign_root_url).append(session_id)
+    return True
+
+
+def send_queued_session(session_id, tm=None, b64_cred=None, esign_root_url=None):
+    """Send a queued session, on the current site.
+
+    The outbox entry is first claimed in a committed transaction, so that only one dispatcher sends it, until the
+    claim is older than SENDING_TIMEOUT.
+    The request is then prepared in a read only transaction and sent outside any transaction, files being read
+    from the committed blobs. The result is written in a new transaction: the session state becomes "sent" or
+    "error", and the digests computed while sending are stored in the session files.
+
+    :param session_id: queued session id
+    :param tm: transaction manager of the used connection, the thread one by default
+    :param b64_cred: base64 encoded credentials for authentication, if not provided the configured ones are used
+    :param esign_root_url: the root URL for the e-sign service, if not provided the configured one is used
+    :return: True if the session was sent
+    """
+    if tm is None:
+        tm = transaction.manager
+    entry = in_transaction(tm, _claim_entry, session_id, datetime.now())
+    if entry is None:
+        return False
+    error = None
+    hashes = {}
+    try:
+        tm.begin()
+        try:
+            external_request = get_external_session_request(
+                session_id,
+                b64_cred=b64_cred,
+                esign_root_url=esign_root_url,
+                endpoint_url=entry["endpoint_url"],
+            )
+        finally:
+            tm.abort()
+        if external_request is None:
+            error = "Session not found"
+        else:
+            session_url, body, headers = external_request
+            response = post_request(session_url, data=body, headers=headers)
+            hashes = body.hashes
+            if response.status_code != 200:
+                error = "HTTP {}: {}".format(response.status_code, response.text)
+    except Exception as exc:
+        logger.exception("Error while sending session %s", session_id)
+        error = repr(exc)
+    in_transaction(tm, _record_result, session_id, error, hashes)
+    return error is None
+
+
+def _claim_entry(annot, session_id, now):
+    """Mark a pending outbox entry, or one whose claim is stale, as being sent.
+
+    :param now: claim datetime
+    :return: the entry or None if it cannot be claimed
+    """
+    entry = annot["outbox"].get(session_id)
+    if entry is None or not _is_claimable(entry, now):
+        return None
+    if entry["status"] == "sending":
+        logger.warning("Session %s claimed at %s is sent again.", session_id, entry.get("claimed"))
+    entry = dict(entry, status="sending", claimed=now)
+    annot["outbox"][session_id] = entry
+    return entry
+
+
+def _dispatch_after_commit(status, db, portal_path, session_ids, b64_cred, esign_root_url):
+    """After commit hook starting a thread dispatching the sessions queued in the transaction."""
+    if not status:
+        return
+    thread = threading.Thread(
+        target=dispatch_external_sessions,
+        args=(db, portal_path, session_ids, b64_cred, esign_root_url),
+        name="imio.esign-dispatch",
+    )
+    thread.start()
+
+
+def _get_transaction_queue(portal, b64_cred, esign_root_url):
+    """Get the list of the session ids queued in the current transaction with the given credentials, dispatched by
+    one after commit hook."""
+    txn = transaction.get()
+    for hook, args, kwargs in txn.getAfterCommitHooks():
+        if hook is _dispatch_after_commit and args[3:] == (b64_cred, esign_root_url):
+            return args[2]
+    session_ids = []
+    txn.addAfterCommitHook(
+        _dispatch_after_commit,
+        args=(portal._p_jar.db(), portal.getPhysicalPath(), session_ids, b64_cred, esign_root_url),
+    )
+    return session_ids
+
+
+def _is_claimable(entry, now):
+    """Check if an outbox entry is pending, or is being sent for more than SENDING_TIMEOUT.
+
+    :param entry: outbox entry
+    :param now: current datetime
+    :return: boolean
+    """
+    if entry["status"] == "pending":
+        return True
+    claimed = entry.get("claimed")
+    return entry["status"] == "sending" and (claimed is None or now - claimed > timedelta(seconds=SENDING_TIMEOUT))
+
+
+def _record_result(annot, session_id, error, hashes):
+    """Remove the outbox entry, store the sent files hashes and set the session state, if not already changed by a
+    feedback."""
+    if session_id in annot["outbox"]:
+        del annot["outbox"][session_id]
+    if error:
+        logger.error("Session %s not sent: %s", session_id, error)
+    else:
+        register_files_hashes(session_id, hashes, annot=annot)
+    session = annot["sessions"].get(session_id)
+    if session is None or session["state"] != "queued":
+        return
+    session["state"] = error and "error" or "sent"
+    session["last_update"] = datetime.now()
+    index_session(session_id, session, annot=annot)
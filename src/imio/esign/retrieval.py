@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""Retrieval of the signed files of the sessions.
+
+When a feedback sets a session in the "to_upload" state, the session is registered to be retrieved.
+Its signed files are downloaded concurrently by a bounded pool of threads, each with its own database connection.
+A file is downloaded by chunks in a temporary file, outside any transaction, then copied by chunks in a new
+version of the annex blob, marked as signed, in a short transaction. The file digest, computed while
+downloading, replaces the one of the sent file in the session. When all the files are retrieved, the session state
+becomes "signed".
+The esign service is called with the credentials and root URL of the configuration, as when sending sessions (see
+utils.get_esign_settings).
+The number of threads can be set with the IMIO_ESIGN_RETRIEVAL_WORKERS environment variable (default 4).
+"""
+from datetime import datetime
+from imio.esign.http_client import get_http_session
+from imio.esign.http_client import get_timeout
+from imio.esign.streaming import CHUNK_SIZE
+from imio.esign.transactions import in_transaction
+from imio.esign.transactions import site_connection
+from imio.esign.utils import get_esign_settings
+from imio.esign.utils import get_readonly_session_annotation
+from imio.esign.utils import get_signed_file_url
+from imio.esign.utils import index_session
+from imio.helpers.content import uuidToObject
+from zope.event import notify
+from zope.lifecycleevent import ObjectModifiedEvent
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+
+try:
+    from queue import Empty
+    from queue import Queue
+except ImportError:  # Python 2
+    from Queue import Empty
+    from Queue import Queue
+
+
+logger = logging.getLogger("imio.esign")
+RETRIEVAL_WORKERS = int(os.getenv("IMIO_ESIGN_RETRIEVAL_WORKERS", 4))
+
+_retrieval_lock = threading.Lock()
+_retrieval_requested = threading.Event()
+
+
+def retrieve_pending_sessions(db, portal_path, b64_cred=None, esign_root_url=None, workers=RETRIEVAL_WORKERS):
+    """Retrieve the signed files of all the sessions registered to be retrieved, as done by a clock server or a cron.
+
+    :param db: ZODB database
+    :param portal_path: portal physical path
+    :param b64_cred: base64 encoded credentials for authentication, if not provided the configured ones are used
+    :param esign_root_url: the root URL for the e-sign service, if not provided the configured one is used
+    :param workers: maximum number of threads per session
+    :return: dict session id -> number of files still to retrieve
+    """
+    with site_connection(db, portal_path):
+        session_ids = list(get_readonly_session_annotation()["retrievals"].keys())
+    return {
+        session_id: retrieve_session_files(
+            db, portal_path, session_id, b64_cred=b64_cred, esign_root_url=esign_root_url, workers=workers
+        )
+        for session_id in session_ids
+    }
+
+
+def retrieve_session_files(db, portal_path, session_id, b64_cred=None, esign_root_url=None, workers=RETRIEVAL_WORKERS):
+    """Retrieve the signed files of a session not already retrieved, concurrently with a bounded number of threads.
+
+    :param db: ZODB database
+    :param portal_path: portal physical path
+    :param session_id: session id
+    :param b64_cred: base64 encoded credentials for authentication, if not provided the configured ones are used
+    :param esign_root_url: the root URL for the e-sign service, if not provided the configured one is used
+    :param workers: maximum number of threads
+    :return: number of files still to retrieve or None if the session is not to be retrieved
+    """
+    b64_cred, esign_root_url = get_esign_settings(b64_cred=b64_cred, esign_root_url=esign_root_url)
+    with site_connection(db, portal_path):
+        annot = get_readonly_session_annotation()
+        session = annot["sessions"].get(session_id)
+        retrieved = annot["retrievals"].get(session_id)
+        if session is None or retrieved is None:
+            return None
+        todo = Queue()
+        for session_file in session["files"]:
+            if session_file["uid"] not in retrieved:
+                url = get_signed_file_url(esign_root_url, session["app_session_id"], session_file["scan_id"])
+                todo.put((session_file["uid"], url))
+    headers = {}
+    if b64_cred:
+        headers["Authorization"] = "Basic {}".format(b64_cred)
+
+    def worker():
+        with site_connection(db, portal_path) as tm:
+            while True:
+                try:
+                    uid, url = todo.get_nowait()
+                except Empty:
+                    return
+                try:
+                    retrieve_signed_file(tm, session_id, uid, url, headers=headers)
+                except Exception:
+                    logger.exception("Error while retrieving file %s of session %s", uid, session_id)
+
+    threads = [
+        threading.Thread(target=worker, name="imio.esign-retrieval-{}".format(i))
+        for i in range(min(workers, todo.qsize()))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with site_connection(db, portal_path) as tm:
+        return in_transaction(tm, _record_retrieval, session_id)
+
+
+def retrieve_signed_file(tm, session_id, uid, url, headers=None):
+    """Download a signed file by chunks and store it in a new version of its annex file, in a new transaction.
+
+    :param tm: transaction manager of the used connection
+    :param session_id: session id
+    :param uid: annex uid
+    :param url: signed file URL
+    :param headers: request headers
+    :return: True if the file was stored
+    """
+    sha = hashlib.sha256()
+    with tempfile.TemporaryFile() as tmp:
+        response = get_http_session().get(url, headers=headers, stream=True, timeout=get_timeout())
+        try:
+            if response.status_code != 200:
+                logger.error("File %s of session %s not retrieved: HTTP %s", uid, session_id, response.status_code)
+                return False
+            for chunk in response.iter_content(CHUNK_SIZE):
+                sha.update(chunk)
+                tmp.write(chunk)
+        finally:
+            response.close()
+        return in_transaction(tm, _store_signed_file, session_id, uid, tmp, sha.hexdigest())
+
+
+def start_retrieval(db, portal_path):
+    """Start a thread retrieving the pending sessions, unless it is already running in this process.
+
+    :param db: ZODB database
+    :param portal_path: portal physical path
+    """
+    _retrieval_requested.set()
+    if not _retrieval_lock.acquire(False):
+        # the running retrieval will run again
+        return
+    thread = threading.Thread(target=_run_retrieval, args=(db, portal_path), name="imio.esign-retrieval")
+    thread.start()
+
+
+def _record_retrieval(annot, session_id):
+    """Set the session as signed when all its files are retrieved.
+
+    :return: number of files still to retrieve
+    """
+    session = annot["sessions"].get(session_id)
+    retrieved = annot["retrievals"].get(session_id)
+    if retrieved is None:
+        return 0
+    if session is None:
+        del annot["retrievals"][session_id]
+        return 0
+    remaining = len([session_file for session_file in session["files"] if session_file["uid"] not in retrieved])
+    if remaining:
+        return remaining
+    del annot["retrievals"][session_id]
+    session["state"] = "signed"
+    session["last_update"] = datetime.now()
+    index_session(session_id, session, annot=annot)
+    return 0
+
+
+def _run_retrieval(db, portal_path):
+    """Retrieve the pending sessions while it is requested. The retrieval lock is acquired by the caller."""
+    while True:
+        try:
+            while _retrieval_requested.is_set():
+                _retrieval_requested.clear()
+                try:
+                    retrieve_pending_sessions(db, portal_path)
+                except Exception:
+                    logger.exception("Error while retrieving signed files")
+        finally:
+            _retrieval_lock.release()
+        # a request may have been done just before the release
+        if not _retrieval_requested.is_set() or not _retrieval_lock.acquire(False):
+            return
+
+
+def _store_signed_file(annot, session_id, uid, tmp, sha256):
+    """Copy the downloaded file in a new version of the annex file, mark the annex as signed and store the new
+    digest in the session file.
+
+    :return: True if the file was stored
+    """
+    retrieved = annot["retrievals"].get(session_id)
+    session = annot["sessions"].get(session_id)
+    if retrieved is None or session is None or uid in retrieved:
+        return False
+    annex = uuidToObject(uid, unrestricted=True)
+    if annex is None:
+        logger.error("Annex %s of session %s not found", uid, session_id)
+        return False
+    tmp.seek(0)
+    with annex.file.open("w") as blob_file:
+        shutil.copyfileobj(tmp, blob_file, CHUNK_SIZE)
+    annex.signed = True
+    notify(ObjectModifiedEvent(annex))
+    # the blob version is only known after the commit
+    session["files"].update_file(uid, {"blob_version": None, "sha256": sha256})
+    retrieved.insert(uid)
+    return True
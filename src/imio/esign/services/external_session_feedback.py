@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
-from datetime import datetime
-from imio.esign.utils import get_session_annotation
+from imio.esign.inbox import enqueue_feedback
 from plone.restapi.deserializer import json_body
 from plone.restapi.services import Service
 
@@ -9,64 +8,69 @@ class ExternalSessionFeedbackPost(Service):
     def reply(self):
         """Handle the external session feedback.
 
+        The feedback is appended to the inbox, applied on the session after the commit.
+        A feedback with an already received code is ignored.
+
         Needs json body with:
             * "app_session_id": "123456", app_session_id
             * "code": "some_code", feedback identification code
             * "session_state": "to_create_session"; session state
             * "sign_url": "http://example.com/sign", sign URL
             * "message": "some message", optional message with feedback
+            * "events": [{"event": 6, "signer": "user1@sign.com", "message": ""}], optional signing events
+              updating the signers status, see SIGNER_EVENTS
         """
         if not self.authorized():
             self.request.response.setStatus(403)
             return {"message": "Unauthorized access"}
         data = json_body(self.request)
-        app_session_id = data.get("app_session_id")
-        if not app_session_id:
-            self.request.response.setStatus(400)
-            return {"message": "app_session_id is required"}
-        code = data.get("code")
-        if not code:
-            self.request.response.setStatus(400)
-            return {"message": "code is required"}
-        try:
-            annot = get_session_annotation()
-            session_id = int(app_session_id[7:])
-            if session_id not in annot["sessions"]:
-                self.request.response.setStatus(400)
-                return {"message": "Session ID {} not found".format(session_id)}
-            session = annot["sessions"][session_id]
-            session_update = {}
-            session_state = data.get("session_state")
-            if session_state and session_state != session["state"]:
-                session_update["state"] = session_state
-            sign_url = data.get("sign_url")
-            if sign_url:
-                session_update["sign_url"] = sign_url
-            if session_update:
-                session.update(session_update)
-                session["last_update"] = datetime.now()
-        except Exception as e:
-            self.request.response.setStatus(500)
-            return {"message": str(e)}
-        return {"message": "Information correctly handled"}
+        status, message = enqueue_feedback(data)
+        if status != 200:
+            self.request.response.setStatus(status)
+        return {"message": message}
 
     def authorized(self):
         """Check if the user is authorized to access this service."""
         return True
 
 
+class ExternalSessionFeedbackBatchPost(ExternalSessionFeedbackPost):
+    def reply(self):
+        """Handle many external session feedbacks in one transaction, appended to the inbox.
+
+        Needs json body with a list of feedbacks, as described in ExternalSessionFeedbackPost, or a dict with
+        this list as "items".
+        Returns the list of each feedback result, in the same order, with "app_session_id", "code", "status"
+        and "message".
+        """
+        if not self.authorized():
+            self.request.response.setStatus(403)
+            return {"message": "Unauthorized access"}
+        data = json_body(self.request)
+        if isinstance(data, dict):
+            data = data.get("items")
+        if not isinstance(data, list):
+            self.request.response.setStatus(400)
+            return {"message": "a list of feedbacks is required"}
+        items = []
+        for item in data:
+            if not isinstance(item, dict):
+                items.append({"status": 400, "message": "a feedback must be an object"})
+                continue
+            status, message = enqueue_feedback(item)
+            items.append(
+                {
+                    "app_session_id": item.get("app_session_id"),
+                    "code": item.get("code"),
+                    "status": status,
+                    "message": message,
+                }
+            )
+        return {"items": items, "items_total": len(items)}
+
+
 """
-Events
-{
-    6: "SIGNATURE_SIGNED",
-    7: "DOCUMENT_DECLINED",
-    8: "DOCUMENT_REINSTATE",
-    10: "STEP_DECLINED",
-    18: "STEP_COMMENT_ADDED",
-    24: "STEP_SUSPENDED",
-    25: "STEP_RESUMED",
-    26: "STEP_CANCELED",
-}
+Events: see imio.esign.inbox.SIGNER_EVENTS
 State:
 to_create_session
 to_sign
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+from imio.esign.utils import BatchItems
+from imio.esign.utils import get_readonly_session_annotation
+from imio.esign.utils import get_sessions_batch
+from imio.esign.utils import SESSIONS_SORT_ON
+from plone.restapi.batching import DEFAULT_BATCH_SIZE
+from plone.restapi.batching import HypermediaBatch
+from plone.restapi.deserializer import parse_int
+from plone.restapi.serializer.converters import json_compatible
+from plone.restapi.services import Service
+
+
+DATETIME_FORMATS = ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d")
+
+
+class SessionsGet(Service):
+    def reply(self):
+        """List the sessions, batched, sorted and filtered, as polled by front-ends and monitoring scripts.
+
+        Query parameters:
+            * "b_start", "b_size": batching
+            * "sort_on": "last_update" (default), "id" or "state"; "sort_order": "descending" or "reverse"
+            * "state": session state
+            * "signer": signer userid or email
+            * "discriminator": session discriminator
+            * "start", "end": last update range, included, as "2025-08-13" or "2025-08-13T10:44:00"
+
+        The ETag header is the sessions modifications counter: a request with this ETag in its If-None-Match
+        header gets a 304 response, without any session being read.
+        """
+        annot = get_readonly_session_annotation()
+        etag = '"{}"'.format(annot["modifications"]())
+        self.request.response.setHeader("ETag", etag)
+        if _etag_matches(self.request.getHeader("If-None-Match"), etag):
+            return self.reply_no_content(status=304)
+        form = self.request.form
+        sort_on = form.get("sort_on") or "last_update"
+        if sort_on not in SESSIONS_SORT_ON:
+            self.request.response.setStatus(400)
+            return {"message": "sort_on must be one of {}".format(", ".join(SESSIONS_SORT_ON))}
+        try:
+            start = _parse_datetime(form.get("start"))
+            end = _parse_datetime(form.get("end"))
+        except ValueError as exc:
+            self.request.response.setStatus(400)
+            return {"message": str(exc)}
+        b_start = parse_int(form, "b_start", 0)
+        b_size = parse_int(form, "b_size", DEFAULT_BATCH_SIZE)
+        if b_start < 0 or b_size < 1:
+            self.request.response.setStatus(400)
+            return {"message": "b_start must be positive and b_size greater than 0"}
+        total, sessions = get_sessions_batch(
+            b_start=b_start,
+            b_size=b_size,
+            sort_on=sort_on,
+            reverse=form.get("sort_order") in ("reverse", "descending"),
+            state=form.get("state") or None,
+            start=start,
+            end=end,
+            signer=form.get("signer") or None,
+            discriminator=form.get("discriminator") or None,
+            annot=annot,
+        )
+        batch = HypermediaBatch(self.request, BatchItems(sessions, total))
+        result = {
+            "@id": batch.canonical_url,
+            "items": [self.serialize_session(session_id, session) for session_id, session in batch],
+            "items_total": batch.items_total,
+        }
+        links = batch.links
+        if links:
+            result["batching"] = links
+        return result
+
+    def serialize_session(self, session_id, session):
+        """Get the json compatible information of a session."""
+        return json_compatible(
+            {
+                "id": session_id,
+                "title": session["title"],
+                "state": session["state"],
+                "last_update": session["last_update"],
+                "app_session_id": session["app_session_id"],
+                "client_id": session["client_id"],
+                "seal": session["seal"],
+                "acroform": session["acroform"],
+                "sign_url": session["sign_url"],
+                "discriminators": list(session["discriminators"] or ()),
+                "signers": [dict(signer) for signer in session["signers"]],
+                "files_count": len(session["files"]),
+            }
+        )
+
+
+def _etag_matches(if_none_match, etag):
+    """Check if an If-None-Match header value matches the etag."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or "W/" + etag in tags
+
+
+def _parse_datetime(value):
+    """Parse a datetime query parameter.
+
+    :param value: date or datetime string, in ISO format
+    :return: datetime or None if no value
+    """
+    if not value:
+        return None
+    for datetime_format in DATETIME_FORMATS:
+        try:
+            return datetime.strptime(value, datetime_format)
+        except ValueError:
+            continue
+    raise ValueError("Invalid datetime {}".format(value))
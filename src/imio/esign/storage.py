@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""Persistent structures used to store esign sessions."""
+from BTrees.IIBTree import IITreeSet
+from BTrees.IOBTree import IOBTree
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
+from os import path
+from persistent import Persistent
+from persistent.list import PersistentList
+from persistent.mapping import PersistentMapping
+
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+
+
+EVENTS_LOG_SIZE = 50
+
+
+class RecordMixin(object):
+    """Dict-style access to the fields of a slotted record.
+
+    Fields missing on an old record are returned as None.
+    """
+
+    __slots__ = ()
+    _fields = ()
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def __getitem__(self, key):
+        if key not in self._fields:
+            raise KeyError(key)
+        return getattr(self, key, None)
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __setitem__(self, key, value):
+        if key not in self._fields:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        if key not in self._fields:
+            return default
+        return getattr(self, key, default)
+
+    def items(self):
+        return [(key, self[key]) for key in self._fields]
+
+    def keys(self):
+        return list(self._fields)
+
+    def update(self, values):
+        for key, value in values.items():
+            self[key] = value
+
+    def values(self):
+        return [self[key] for key in self._fields]
+
+
+class Session(RecordMixin, Persistent):
+    """An esign session, stored as its own persistent record.
+
+    Modifying a session only writes this record, not the whole sessions container.
+    Signers are indexed by userid and email, and the last received events are kept in a bounded log.
+    """
+
+    _fields = __slots__ = (
+        "acroform",
+        "app_session_id",
+        "client_id",
+        "discriminators",
+        "events",
+        "files",
+        "last_update",
+        "seal",
+        "sign_url",
+        "signer_index",
+        "signers",
+        "state",
+        "title",
+    )
+
+    def __init__(self, **kwargs):
+        self.acroform = True
+        self.app_session_id = None
+        self.client_id = None
+        self.discriminators = ()
+        self.events = PersistentList()
+        self.files = SessionFiles()
+        self.last_update = None
+        self.seal = None
+        self.sign_url = None
+        self.signers = PersistentList()
+        self.state = "draft"
+        self.title = None
+        self.update(kwargs)
+        self.index_signers()
+
+    def __repr__(self):
+        return "<Session {} ({})>".format(self.title, self.state)
+
+    def add_event(self, event):
+        """Append an event to the log, keeping only the EVENTS_LOG_SIZE last ones.
+
+        :param event: (datetime, event code, signer userid or email, message) tuple
+        """
+        if self.get("events") is None:
+            self.events = PersistentList()
+        self.events.append(event)
+        if len(self.events) > EVENTS_LOG_SIZE:
+            del self.events[:-EVENTS_LOG_SIZE]
+
+    def get_signer(self, key):
+        """Get a signer by its userid or email.
+
+        :param key: signer userid or email
+        :return: signer dict or None if not found
+        """
+        if self.get("signer_index") is None:
+            self.index_signers()
+        position = self.signer_index.get(key)
+        if position is None:
+            return None
+        return self.signers[position]
+
+    def index_signers(self):
+        """Index the signers positions by userid and email, to be called when signers are changed."""
+        index = {}
+        for position, signer in enumerate(self.signers):
+            for key in (signer.get("userid"), signer.get("email")):
+                if key:
+                    index.setdefault(key, position)
+        self.signer_index = index
+
+
+class SessionFile(RecordMixin):
+    """A file of a session, pickled inside its session files container as a compact tuple.
+
+    As it is not persistent, its container must be marked as changed when it is modified.
+    New fields are appended, so that older pickled tuples are still read correctly.
+    The SHA-256 digest of the file content is stored with the (oid, serial) version of the blob it was computed
+    from, so that it is not computed again while the file is not changed.
+    """
+
+    _fields = __slots__ = ("context_uid", "filename", "scan_id", "title", "uid", "sha256", "blob_version")
+
+    def __init__(self, uid, context_uid, filename, scan_id, title, sha256=None, blob_version=None):
+        self.uid = uid
+        self.context_uid = context_uid
+        self.filename = filename
+        self.scan_id = scan_id
+        self.title = title
+        self.sha256 = sha256
+        self.blob_version = blob_version
+
+    def __getstate__(self):
+        return tuple(getattr(self, key, None) for key in self._fields)
+
+    def __setstate__(self, state):
+        for key, value in zip(self._fields, state):
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return "<SessionFile {} ({})>".format(self.filename, self.uid)
+
+
+class SessionFiles(Persistent):
+    """Ordered container of the files of a session, also indexed by file uid.
+
+    Files are kept in insertion order in an IOBTree and the uid index gives their position key,
+    so getting or removing a file by uid does not iterate over the session files.
+    Used filenames stems are registered, with a next suffix counter per stem, to get unique filenames.
+    """
+
+    def __init__(self, files=()):
+        self._files = IOBTree()
+        self._positions = OOBTree()
+        self._next_position = 0
+        self._stems = OOTreeSet()
+        self._stem_counters = OOBTree()
+        for session_file in files:
+            self.append(session_file)
+
+    def __contains__(self, uid):
+        return uid in self._positions
+
+    def __getitem__(self, index):
+        """Get a file by its index in the container, like a list."""
+        return self._files.values()[index]
+
+    def __iter__(self):
+        return iter(self._files.values())
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __repr__(self):
+        return "<SessionFiles {}>".format(list(self))
+
+    def append(self, session_file):
+        """Add a file at the end of the container.
+
+        :param session_file: a SessionFile, whose uid is not already in the container
+        """
+        if session_file.uid in self._positions:
+            raise ValueError("File uid {} already in session files".format(session_file.uid))
+        position = self._next_position
+        self._next_position += 1
+        self._files[position] = session_file
+        self._positions[session_file.uid] = position
+        self._stems.insert(path.splitext(session_file.filename)[0])
+
+    def get(self, uid, default=None):
+        """Get a file by its uid."""
+        position = self._positions.get(uid)
+        if position is None:
+            return default
+        return self._files[position]
+
+    def get_unique_stem(self, stem):
+        """Get a filename stem not used in the container, suffixing it with "-1", "-2"... if needed.
+
+        Suffixes are not reused when files are removed.
+
+        :param stem: filename without extension
+        :return: unique stem
+        """
+        if stem not in self._stems:
+            return stem
+        suffix = self._stem_counters.get(stem, 1)
+        new_stem = u"{}-{}".format(stem, suffix)
+        while new_stem in self._stems:
+            suffix += 1
+            new_stem = u"{}-{}".format(stem, suffix)
+        self._stem_counters[stem] = suffix + 1
+        return new_stem
+
+    def remove(self, uid):
+        """Remove a file by its uid.
+
+        :param uid: file uid
+        :return: the removed SessionFile or None if not found
+        """
+        position = self._positions.get(uid)
+        if position is None:
+            return None
+        del self._positions[uid]
+        session_file = self._files[position]
+        del self._files[position]
+        stem = path.splitext(session_file.filename)[0]
+        if stem in self._stems:
+            self._stems.remove(stem)
+        return session_file
+
+    def update_file(self, uid, values):
+        """Update fields of a file by its uid, storing a new record so that the change is persisted.
+
+        :param uid: file uid
+        :param values: dict of field values
+        :return: the updated SessionFile or None if not found
+        """
+        position = self._positions.get(uid)
+        if position is None:
+            return None
+        session_file = SessionFile(**dict(self._files[position].items(), **values))
+        self._files[position] = session_file
+        return session_file
+
+
+class EmptySessionStorage(Mapping):
+    """Read only view of an empty esign sessions storage, used to read when nothing has been stored yet.
+
+    Its structures are new ones, not added to the database, so reading them never writes anything.
+    """
+
+    def __init__(self):
+        self._storage = dict(new_session_storage())
+
+    def __getitem__(self, key):
+        return self._storage[key]
+
+    def __iter__(self):
+        return iter(self._storage)
+
+    def __len__(self):
+        return len(self._storage)
+
+
+def new_session_storage():
+    """Return an empty esign sessions storage.
+
+    * "numbering": conflict resolving counter of the reserved session ids, a new block of ids starting at its value
+    * "count": conflict resolving counter of stored sessions
+    * "sessions": IOBTree of Session, keyed by session id
+    * "uids": OOBTree file uid -> session id
+    * "c_uids": OOBTree context uid -> OOTreeSet of file uids
+    * "discriminations": OOTreeSet of (discrimination key, draft session id) pairs
+    * "states": OOBTree state -> IITreeSet of session ids, sets being kept when empty to avoid write conflicts
+    * "last_updates": OOTreeSet of (last update datetime, session id) pairs, datetime.min for no last update
+    * "indexed": IOBTree session id -> (state, last_update) as indexed in "states" and "last_updates"
+    * "signers": OOTreeSet of (signer userid or email, session id) pairs
+    * "discriminators": OOTreeSet of (discriminator, session id) pairs
+    * "modifications": conflict resolving counter of the sessions changes, used to know if they changed
+    * "outbox": IOBTree session id -> dict entry of a session queued to be sent
+    * "inbox": OOBTree (reception datetime, code) -> feedback dict not yet applied on its session
+    * "feedback_codes": OOBTree code -> reception datetime of the received feedbacks
+    * "feedback_receptions": OOTreeSet of (reception datetime, code) pairs of "feedback_codes", to forget old codes
+    * "app_session_ids": OOBTree session id in the esign service (as string) -> session id
+    * "retrievals": IOBTree session id -> OOTreeSet of the retrieved file uids, for sessions whose signed files
+      are to be retrieved
+
+    Indexes of pairs are used for keys that concurrent transactions may add: they insert different pairs, merged
+    by conflict resolution, instead of each creating a set for a same new key.
+    """
+    return PersistentMapping(
+        {
+            "numbering": Length(),
+            "count": Length(),
+            "sessions": IOBTree(),
+            "uids": OOBTree(),
+            "c_uids": OOBTree(),
+            "discriminations": OOTreeSet(),
+            "states": OOBTree({"draft": IITreeSet()}),
+            "last_updates": OOTreeSet(),
+            "indexed": IOBTree(),
+            "signers": OOTreeSet(),
+            "discriminators": OOTreeSet(),
+            "modifications": Length(),
+            "outbox": IOBTree(),
+            "inbox": OOBTree(),
+            "feedback_codes": OOBTree(),
+            "feedback_receptions": OOTreeSet(),
+            "app_session_ids": OOBTree(),
+            "retrievals": IOBTree(),
+        }
+    )
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""Streaming of multipart/form-data request bodies."""
+from io import BytesIO
+from ZODB.interfaces import BlobError
+
+import hashlib
+import os
+import uuid
+
+
+CHUNK_SIZE = 64 * 1024
+CRLF = b"\r\n"
+
+
+def blob_version(named_file):
+    """Get the version of the committed blob of a named blob file, changing each time a new content is committed.
+
+    :param named_file: a named (blob) file
+    :return: (blob oid, blob serial), or None if it has no committed blob
+    """
+    blob = getattr(named_file, "_blob", None)
+    if blob is None:
+        return None
+    blob._p_activate()
+    try:
+        blob.committed()
+    except BlobError:
+        return None
+    return blob._p_oid, blob._p_serial
+
+
+def detach_blob_file(named_file):
+    """Get a file part reading the committed blob of a named blob file directly from the filesystem.
+
+    It can be streamed after the end of the transaction, without using the database connection.
+
+    :param named_file: a named (blob) file
+    :return: a FilesystemFile, or the named file itself if it has no committed blob
+    """
+    blob = getattr(named_file, "_blob", None)
+    if blob is None:
+        return named_file
+    blob._p_activate()
+    try:
+        path = blob.committed()
+    except BlobError:
+        return named_file
+    return FilesystemFile(path, content_type=named_file.contentType)
+
+
+def _header_param(value):
+    """Encode a Content-Disposition parameter value like browsers do (html5 way)."""
+    if not isinstance(value, bytes):
+        value = value.encode("utf-8")
+    return value.replace(b"\\", b"\\\\").replace(b'"', b"%22").replace(b"\r", b"%0D").replace(b"\n", b"%0A")
+
+
+def _open_file(named_file):
+    if hasattr(named_file, "open"):
+        return named_file.open()
+    return BytesIO(named_file.data)
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode("utf-8")
+
+
+class FilesystemFile(object):
+    """File part read from a filesystem path."""
+
+    def __init__(self, path, content_type=None):
+        self.path = path
+        self.contentType = content_type
+
+    def getSize(self):
+        return os.path.getsize(self.path)
+
+    def open(self):
+        return open(self.path, "rb")
+
+
+class MultipartStream(object):
+    """File-like multipart/form-data body, reading file parts by chunks only when sent.
+
+    It can be given as data to requests: its length is known so the Content-Length header is set,
+    and the body is read by blocks. Memory usage is bounded by the chunk size, whatever the files size.
+    The SHA-256 digests of the files given with a key are computed while they are read, in the hashes attribute,
+    unless they are already known.
+
+    :param fields: list of (name, value) text fields
+    :param files: list of (name, filename, file), (name, filename, file, key) or (name, filename, file, key, sha256)
+                  where file is a named file like object, with getSize() and contentType, and open() (blob) or data,
+                  key is the key of its digest in hashes and sha256 its already known digest, not computed again
+    :param boundary: optional multipart boundary
+    :param chunk_size: size of file chunks read
+    """
+
+    def __init__(self, fields=(), files=(), boundary=None, chunk_size=CHUNK_SIZE):
+        self.boundary = boundary or uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary={}".format(self.boundary)
+        self.chunk_size = chunk_size
+        self.files_count = len(files)
+        self.hashes = {}
+        # parts are bytes or (named file, hash key) pairs
+        self._parts = []
+        for name, value in fields:
+            self._parts.append(
+                self._part_header(b'form-data; name="' + _header_param(name) + b'"') + _to_bytes(value) + CRLF
+            )
+        for file_part in files:
+            name, filename, named_file, key, sha256 = (tuple(file_part) + (None, None))[:5]
+            if sha256 is not None:
+                self.hashes[key] = sha256
+                key = None
+            self._parts.append(
+                self._part_header(
+                    b'form-data; name="' + _header_param(name) + b'"; filename="' + _header_param(filename) + b'"',
+                    getattr(named_file, "contentType", None),
+                )
+            )
+            self._parts.append((named_file, key))
+            self._parts.append(CRLF)
+        self._parts.append(b"--" + _to_bytes(self.boundary) + b"--" + CRLF)
+        self.len = sum(len(part) if isinstance(part, bytes) else part[0].getSize() for part in self._parts)
+        self.seek(0)
+
+    def __len__(self):
+        return self.len
+
+    def __repr__(self):
+        return "<MultipartStream {} bytes, {} files>".format(self.len, self.files_count)
+
+    def _part_header(self, disposition, content_type=None):
+        header = b"--" + _to_bytes(self.boundary) + CRLF + b"Content-Disposition: " + disposition + CRLF
+        if content_type:
+            header += b"Content-Type: " + _to_bytes(content_type) + CRLF
+        return header + CRLF
+
+    def _chunks(self):
+        for part in self._parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            named_file, key = part
+            sha = key is not None and hashlib.sha256() or None
+            fd = _open_file(named_file)
+            try:
+                while True:
+                    chunk = fd.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    if sha is not None:
+                        sha.update(chunk)
+                    yield chunk
+            finally:
+                fd.close()
+            if sha is not None:
+                self.hashes[key] = sha.hexdigest()
+
+    def read(self, size=-1):
+        """Read at most size bytes, all remaining bytes if size is negative."""
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            chunk = next(self._iterator, None)
+            if chunk is None:
+                break
+            chunks.append(chunk)
+            length += len(chunk)
+        data = b"".join(chunks)
+        if size >= 0:
+            data, self._buffer = data[:size], data[size:]
+        else:
+            self._buffer = b""
+        self._position += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        """Only rewinding to the start is supported, so that the body can be sent again."""
+        if offset != 0 or whence != 0:
+            raise IOError("MultipartStream can only be rewound to its start")
+        self._iterator = self._chunks()
+        self._buffer = b""
+        self._position = 0
+
+    def tell(self):
+        return self._position
@@ -1,13 +1,33 @@
 # -*- coding: utf-8 -*-
+from imio.esign.http_client import reset_http_session
+from persistent import Persistent
+from plone import api
 from plone.app.robotframework.testing import REMOTE_LIBRARY_BUNDLE_FIXTURE
 from plone.app.testing import applyProfile
 from plone.app.testing import FunctionalTesting
 from plone.app.testing import IntegrationTesting
 from plone.app.testing import PLONE_FIXTURE
 from plone.app.testing import PloneSandboxLayer
+from plone.namedfile.file import NamedBlobFile
+from plone.namedfile.file import NamedBlobImage
 from plone.testing import z2
+from threading import Thread
+from ZODB.blob import Blob
 
+import collective.iconifiedcategory
 import imio.esign  # noqa: F401
+import os
+import time
+
+
+try:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
 
 
 class ImioEsignLayer(PloneSandboxLayer):
@@ -34,6 +54,168 @@ class ImioEsignLayer(PloneSandboxLayer):
         applyProfile(portal, "imio.esign:default")
 
 
+def add_annexes(portal, count=10):
+    """Add a to sign annexes category configuration, 2 folders and annexes in them.
+
+    :param portal: portal
+    :param count: number of annexes
+    :return: folders list and annexes uids list
+    """
+    # add content category configuration
+    at_folder = api.content.create(
+        container=portal,
+        id="annexes_types",
+        title="Annexes Types",
+        type="ContentCategoryConfiguration",
+        exclude_from_nav=True,
+    )
+    category_group = api.content.create(
+        type="ContentCategoryGroup",
+        title="Annexes",
+        container=at_folder,
+        id="annexes",
+    )
+    icon_path = os.path.join(os.path.dirname(collective.iconifiedcategory.__file__), "tests", "icône1.png")
+    with open(icon_path, "rb") as fl:
+        api.content.create(
+            type="ContentCategory",
+            title="To sign",
+            container=category_group,
+            icon=NamedBlobImage(fl.read(), filename=u"icône1.png"),
+            id="to_sign",
+            predefined_title="To be signed",
+            # confidential=True,
+            # to_print=True,
+            to_sign=True,
+            # signed=True,
+            # publishable=True,
+            # only_pdf=True,
+            show_preview=False,
+        )
+    # add annexes
+    folders = []
+    for f in range(2):
+        folder = api.content.create(
+            container=portal,
+            id="folder{}".format(f),
+            title="Folder {}".format(f),
+            type="Folder",
+        )
+        folders.append(folder)
+    tests_dir = os.path.join(os.path.dirname(__file__), "tests")
+    pdf_files = ["annex1.pdf", "annex2.pdf"]
+    uids = []
+    for i in range(count):
+        pdf_file = pdf_files[i % len(pdf_files)]
+        container = folders[i % len(folders)]
+        with open(os.path.join(tests_dir, pdf_file), "rb") as f:
+            annex = api.content.create(
+                container=container,
+                type="annex",
+                id="annex{}".format(i),
+                title="Annex {}".format(i),
+                content_category="to_sign",
+                scan_id="0123456000000{:02d}".format(i),
+                file=NamedBlobFile(data=f.read(), filename=u"annex{}.pdf".format(i), contentType="application/pdf"),
+            )
+            uids.append(annex.UID())
+    return folders, uids
+
+
+class DummyNamedBlobFile(Persistent):
+    """Named blob file like object, storing its data in a blob, counting its openings."""
+
+    contentType = "application/pdf"
+
+    def __init__(self, data):
+        self._blob = Blob(data)
+        self.opened = 0
+
+    def open(self):
+        self.opened += 1
+        return self._blob.open("r")
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Stand-in for the esign service, recording received POST requests and serving documents on GET.
+
+    The server attributes "status" and "delay" define the responses.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # idle kept alive connections are closed
+    timeout = 1
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        self.server.received.append((self.client_address, dict(self.headers.items()), self.rfile.read(length)))
+        time.sleep(self.server.delay)
+        body = b'{"message": "ok"}'
+        self.send_response(self.server.status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        body = self.server.documents.get(self.path)
+        if body is None:
+            self.send_response(404)
+            body = b'{"message": "not found"}'
+        else:
+            self.send_response(self.server.status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+
+    # server_close waits for handling threads
+    daemon_threads = False
+
+    def handle_error(self, request, client_address):
+        """Ignore errors of clients gone away, as when testing a timeout."""
+
+
+class StandInServer(object):
+    """Local http server standing in for the esign service, as a context manager giving itself.
+
+    :param status: responses status
+    :param delay: seconds to wait before responding
+    :param documents: dict url path -> bytes served on GET
+    """
+
+    def __init__(self, status=200, delay=0, documents=None):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        self.server.documents = documents or {}
+        self.server.received = []
+        self.server.status = status
+        self.server.delay = delay
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+
+    @property
+    def received(self):
+        """List of (client address, headers, body) received requests."""
+        return self.server.received
+
+    def __enter__(self):
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *args):
+        # close kept alive connections
+        reset_http_session()
+        self.server.shutdown()
+        self.server.server_close()
+
+
 IMIO_ESIGN_FIXTURE = ImioEsignLayer()
 
 
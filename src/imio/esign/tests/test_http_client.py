@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""http client tests for this package."""
+from imio.esign.http_client import get_http_session
+from imio.esign.http_client import get_http_settings
+from imio.esign.http_client import get_timeout
+from imio.esign.http_client import reset_http_session
+from imio.esign.testing import StandInServer
+from imio.esign.utils import post_request
+
+import os
+import requests
+import unittest
+
+
+class TestHttpClient(unittest.TestCase):
+    def setUp(self):
+        reset_http_session()
+
+    def tearDown(self):
+        for key in ("IMIO_ESIGN_READ_TIMEOUT", "IMIO_ESIGN_RETRIES", "IMIO_ESIGN_POOL_MAXSIZE"):
+            os.environ.pop(key, None)
+        reset_http_session()
+
+    def test_settings(self):
+        self.assertEqual(get_timeout(), (5.0, 120.0))
+        os.environ["IMIO_ESIGN_READ_TIMEOUT"] = "30"
+        os.environ["IMIO_ESIGN_RETRIES"] = "1"
+        os.environ["IMIO_ESIGN_POOL_MAXSIZE"] = "2"
+        self.assertEqual(get_timeout(), (5.0, 30.0))
+        self.assertEqual(get_http_settings()["retries"], 1)
+        session = get_http_session()
+        self.assertIs(get_http_session(), session)
+        adapter = session.get_adapter("https://esign.example.org")
+        self.assertEqual(adapter.max_retries.total, 1)
+        self.assertEqual(adapter._pool_maxsize, 2)
+
+    def test_keep_alive(self):
+        with StandInServer() as server:
+            for i in range(3):
+                self.assertEqual(post_request(server.url, data={"i": i}).status_code, 200)
+        self.assertEqual(len(server.received), 3)
+        # the same connection is reused
+        self.assertEqual(len(set(address for address, headers, body in server.received)), 1)
+
+    def test_timeout(self):
+        with StandInServer(delay=0.5) as server:
+            self.assertRaises(requests.Timeout, post_request, server.url, data={"a": 1}, timeout=(1, 0.2))
+
+    def test_no_post_retry_on_status(self):
+        with StandInServer(status=503) as server:
+            self.assertEqual(post_request(server.url, data={"a": 1}).status_code, 503)
+        self.assertEqual(len(server.received), 1)
+
+    def test_connect_retries(self):
+        os.environ["IMIO_ESIGN_RETRIES"] = "2"
+        with StandInServer() as server:
+            url = server.url
+        # nothing listens anymore
+        self.assertRaises(requests.ConnectionError, post_request, url, data={"a": 1})
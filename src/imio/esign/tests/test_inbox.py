@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""inbox tests for this package."""
+from datetime import datetime
+from datetime import timedelta
+from imio.esign.inbox import enqueue_feedback
+from imio.esign.inbox import FEEDBACK_CODES_DAYS
+from imio.esign.inbox import process_feedback_inbox
+from imio.esign.testing import add_annexes
+from imio.esign.testing import IMIO_ESIGN_FUNCTIONAL_TESTING
+from imio.esign.utils import add_files_to_session
+from imio.esign.utils import get_session_annotation
+from imio.esign.utils import register_app_session_id
+from plone.app.testing import setRoles
+from plone.app.testing import TEST_USER_ID
+
+import threading
+import transaction
+import unittest
+
+
+class TestInbox(unittest.TestCase):
+
+    layer = IMIO_ESIGN_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+        setRoles(self.portal, TEST_USER_ID, ["Manager"])
+        self.folders, self.uids = add_annexes(self.portal, count=1)
+        signers = [("user1", "user1@sign.com", "User 1", "Position 1")]
+        self.sid, session = add_files_to_session(signers, self.uids)
+        self.app_session_id = register_app_session_id(self.sid)
+        transaction.commit()
+
+    def test_applied_after_commit(self):
+        annot = get_session_annotation()
+        app_session_id = self.app_session_id
+        self.assertEqual(
+            enqueue_feedback({"app_session_id": app_session_id, "code": "c1", "session_state": "to_sign"}),
+            (200, "Information correctly handled"),
+        )
+        self.assertEqual(len(annot["inbox"]), 1)
+        self.assertEqual(annot["sessions"][self.sid]["state"], "draft")
+        transaction.commit()
+        for thread in threading.enumerate():
+            if thread.name == "imio.esign-feedbacks":
+                thread.join(10)
+        transaction.begin()
+        self.assertEqual(len(annot["inbox"]), 0)
+        self.assertIn("c1", annot["feedback_codes"])
+        self.assertEqual(annot["sessions"][self.sid]["state"], "to_sign")
+
+    def test_feedback_codes_pruned(self):
+        annot = get_session_annotation()
+        old = datetime.now() - timedelta(days=FEEDBACK_CODES_DAYS + 1)
+        recent = datetime.now() - timedelta(days=FEEDBACK_CODES_DAYS - 1)
+        for received, code in ((old, "old"), (recent, "recent")):
+            annot["feedback_codes"][code] = received
+            annot["feedback_receptions"].insert((received, code))
+        # old codes are forgotten when a feedback is received
+        self.assertEqual(
+            enqueue_feedback({"app_session_id": self.app_session_id, "code": "old", "session_state": "to_sign"}),
+            (200, "Information correctly handled"),
+        )
+        self.assertEqual(
+            enqueue_feedback({"app_session_id": self.app_session_id, "code": "recent", "session_state": "to_sign"}),
+            (200, "Information already handled"),
+        )
+        self.assertEqual(sorted(annot["feedback_codes"].keys()), ["old", "recent"])
+        self.assertEqual([code for received, code in annot["feedback_receptions"]], ["recent", "old"])
+        self.assertEqual(len(annot["inbox"]), 1)
+
+    def test_process_feedback_inbox(self):
+        annot = get_session_annotation()
+        app_session_id = self.app_session_id
+        # feedbacks received before a restart
+        for i, state in enumerate(("to_sign", "to_upload", "signed")):
+            code = "c{}".format(i)
+            annot["inbox"][(datetime(2025, 9, 1, 10, 0, i), code)] = {
+                "app_session_id": app_session_id,
+                "code": code,
+                "session_state": state,
+            }
+        transaction.commit()
+        db = self.portal._p_jar.db()
+        self.assertEqual(process_feedback_inbox(db, self.portal.getPhysicalPath(), batch_size=2), 3)
+        transaction.begin()
+        self.assertEqual(len(annot["inbox"]), 0)
+        # applied in reception order
+        self.assertEqual(annot["sessions"][self.sid]["state"], "signed")
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""retrieval tests for this package."""
+from imio.esign.inbox import apply_session_feedback
+from imio.esign.retrieval import retrieve_pending_sessions
+from imio.esign.retrieval import retrieve_session_files
+from imio.esign.testing import add_annexes
+from imio.esign.testing import IMIO_ESIGN_FUNCTIONAL_TESTING
+from imio.esign.testing import StandInServer
+from imio.esign.utils import add_files_to_session
+from imio.esign.utils import get_session_annotation
+from imio.esign.utils import register_app_session_id
+from imio.helpers.content import uuidToObject
+from plone.app.testing import setRoles
+from plone.app.testing import TEST_USER_ID
+
+import hashlib
+import os
+import transaction
+import unittest
+
+
+class TestRetrieval(unittest.TestCase):
+
+    layer = IMIO_ESIGN_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+        setRoles(self.portal, TEST_USER_ID, ["Manager"])
+        self.folders, self.uids = add_annexes(self.portal, count=3)
+        signers = [("user1", "user1@sign.com", "User 1", "Position 1")]
+        self.sid, self.session = add_files_to_session(signers, self.uids)
+        app_session_id = register_app_session_id(self.sid)
+        annot = get_session_annotation()
+        apply_session_feedback({"app_session_id": app_session_id, "code": "c1", "session_state": "to_upload"}, annot)
+        transaction.commit()
+        self.documents = {
+            "/imio/esign/v1/luxtrust/sessions/{}/files/{}".format(app_session_id, session_file["scan_id"]): (
+                b"%PDF-1.4 signed " + session_file["scan_id"].encode("ascii")
+            )
+            for session_file in self.session["files"]
+        }
+
+    def tearDown(self):
+        os.environ.pop("IMIO_ESIGN_ROOT_URL", None)
+
+    def _retrieve(self, documents):
+        with StandInServer(documents=documents) as server:
+            remaining = retrieve_session_files(
+                self.portal._p_jar.db(), self.portal.getPhysicalPath(), self.sid, esign_root_url=server.url, workers=2
+            )
+        transaction.begin()
+        return remaining
+
+    def test_retrieve_session_files(self):
+        annot = get_session_annotation()
+        self.assertIn(self.sid, annot["retrievals"])
+        self.assertEqual(self._retrieve(self.documents), 0)
+        for uid in self.uids:
+            annex = uuidToObject(uid, unrestricted=True)
+            self.assertTrue(annex.signed)
+            self.assertEqual(annex.file.data, self.documents[sorted(self.documents)[self.uids.index(uid)]])
+            # the session file digest is the signed file one
+            self.assertEqual(
+                annot["sessions"][self.sid]["files"].get(uid)["sha256"], hashlib.sha256(annex.file.data).hexdigest()
+            )
+        self.assertEqual(annot["sessions"][self.sid]["state"], "signed")
+        self.assertNotIn(self.sid, annot["retrievals"])
+        # nothing more to retrieve
+        self.assertIsNone(self._retrieve(self.documents))
+
+    def test_retrieve_missing_files(self):
+        annot = get_session_annotation()
+        first_path = sorted(self.documents)[0]
+        self.assertEqual(self._retrieve({first_path: self.documents[first_path]}), 2)
+        self.assertTrue(uuidToObject(self.uids[0], unrestricted=True).signed)
+        self.assertFalse(getattr(uuidToObject(self.uids[1], unrestricted=True), "signed", False))
+        self.assertEqual(annot["sessions"][self.sid]["state"], "to_upload")
+        self.assertEqual(list(annot["retrievals"][self.sid]), [self.uids[0]])
+        # the remaining files are retrieved later, from the configured esign service
+        with StandInServer(documents=self.documents) as server:
+            os.environ["IMIO_ESIGN_ROOT_URL"] = server.url
+            results = retrieve_pending_sessions(self.portal._p_jar.db(), self.portal.getPhysicalPath())
+        self.assertEqual(results, {self.sid: 0})
+        transaction.begin()
+        self.assertEqual(annot["sessions"][self.sid]["state"], "signed")
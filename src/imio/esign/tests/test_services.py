@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""services tests for this package."""
+from datetime import datetime
+from imio.esign.inbox import apply_feedback_inbox
+from imio.esign.services.external_session_feedback import ExternalSessionFeedbackBatchPost
+from imio.esign.services.external_session_feedback import ExternalSessionFeedbackPost
+from imio.esign.services.sessions import SessionsGet
+from imio.esign.testing import add_annexes
+from imio.esign.testing import IMIO_ESIGN_INTEGRATION_TESTING
+from imio.esign.utils import add_files_to_session
+from imio.esign.utils import index_session
+from imio.esign.utils import register_app_session_id
+from plone.app.testing import setRoles
+from plone.app.testing import TEST_USER_ID
+
+import json
+import unittest
+
+
+class TestExternalSessionFeedback(unittest.TestCase):
+
+    layer = IMIO_ESIGN_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+        self.request = self.layer["request"]
+        setRoles(self.portal, TEST_USER_ID, ["Manager"])
+        self.folders, self.uids = add_annexes(self.portal, count=2)
+        signers = [("user1", "user1@sign.com", "User 1", "Position 1")]
+        self.sid, self.session = add_files_to_session(signers, self.uids[:1])
+        self.sid2, self.session2 = add_files_to_session(signers, self.uids[1:], discriminators=("other",))
+        self.app_id = register_app_session_id(self.sid)
+        self.app_id2 = register_app_session_id(self.sid2)
+
+    def _reply(self, klass, data):
+        self.request["BODY"] = json.dumps(data)
+        return klass(self.portal, self.request).reply()
+
+    def test_feedback(self):
+        ret = self._reply(
+            ExternalSessionFeedbackPost,
+            {"app_session_id": self.app_id, "code": "c1", "session_state": "to_sign"},
+        )
+        self.assertEqual(ret, {"message": "Information correctly handled"})
+        # the feedback is applied from the inbox
+        self.assertEqual(self.session["state"], "draft")
+        self.assertEqual(apply_feedback_inbox(), 1)
+        self.assertEqual(self.session["state"], "to_sign")
+        # a duplicate delivery is ignored
+        ret = self._reply(
+            ExternalSessionFeedbackPost,
+            {"app_session_id": self.app_id, "code": "c1", "session_state": "to_upload"},
+        )
+        self.assertEqual(ret, {"message": "Information already handled"})
+        self.assertEqual(apply_feedback_inbox(), 0)
+        self.assertEqual(self.session["state"], "to_sign")
+        ret = self._reply(ExternalSessionFeedbackPost, {"app_session_id": self.app_id})
+        self.assertEqual(ret, {"message": "code is required"})
+        self.assertEqual(self.request.response.getStatus(), 400)
+
+    def test_feedback_events(self):
+        ret = self._reply(
+            ExternalSessionFeedbackPost,
+            {
+                "app_session_id": self.app_id,
+                "code": "c1",
+                "events": [
+                    {"event": 18, "signer": "user1", "message": "ok"},
+                    {"event": 6, "signer": "user1@sign.com"},
+                    {"event": 6, "signer": "unknown@sign.com"},
+                ],
+            },
+        )
+        self.assertEqual(ret, {"message": "Information correctly handled"})
+        apply_feedback_inbox()
+        self.assertEqual(self.session["signers"][0]["status"], "signed")
+        self.assertEqual(len(self.session["events"]), 3)
+        self.assertEqual(self.session["events"][0][1:], (18, "user1", "ok"))
+        ret = self._reply(ExternalSessionFeedbackPost, {"app_session_id": self.app_id, "code": "c2", "events": [6]})
+        self.assertEqual(ret, {"message": "events must be a list of objects"})
+
+    def test_feedback_batch(self):
+        ret = self._reply(
+            ExternalSessionFeedbackBatchPost,
+            [
+                {"app_session_id": self.app_id, "code": "c1", "session_state": "to_sign"},
+                {"app_session_id": self.app_id2, "code": "c2", "sign_url": "http://sign/2"},
+                {"app_session_id": self.app_id2},
+                {"app_session_id": "01234561", "code": "c4"},
+                "wrong",
+            ],
+        )
+        self.assertEqual(ret["items_total"], 5)
+        self.assertEqual([item["status"] for item in ret["items"]], [200, 200, 400, 400, 400])
+        self.assertEqual(ret["items"][0]["code"], "c1")
+        self.assertEqual(ret["items"][3]["message"], "Session 01234561 not found")
+        self.assertEqual(apply_feedback_inbox(), 2)
+        self.assertEqual(self.session["state"], "to_sign")
+        self.assertEqual(self.session2["state"], "draft")
+        self.assertEqual(self.session2["sign_url"], "http://sign/2")
+        # items can be given in a dict
+        ret = self._reply(
+            ExternalSessionFeedbackBatchPost,
+            {"items": [{"app_session_id": self.app_id2, "code": "c5", "session_state": "to_sign"}]},
+        )
+        self.assertEqual(ret["items"][0]["status"], 200)
+        apply_feedback_inbox()
+        self.assertEqual(self.session2["state"], "to_sign")
+        ret = self._reply(ExternalSessionFeedbackBatchPost, {"app_session_id": self.app_id})
+        self.assertEqual(ret, {"message": "a list of feedbacks is required"})
+
+
+class TestSessionsGet(unittest.TestCase):
+
+    layer = IMIO_ESIGN_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+        self.request = self.layer["request"]
+        setRoles(self.portal, TEST_USER_ID, ["Manager"])
+        self.folders, self.uids = add_annexes(self.portal, count=3)
+        signers = [("user1", "user1@sign.com", "User 1", "Position 1")]
+        self.sid, self.session = add_files_to_session(signers, self.uids[:1])
+        self.sid2, self.session2 = add_files_to_session(signers, self.uids[1:2], discriminators=("other",))
+        signers.append(("user2", "user2@sign.com", "User 2", "Position 2"))
+        self.sid3, self.session3 = add_files_to_session(signers, self.uids[2:])
+        self.session3["state"] = "to_sign"
+        self.session3["last_update"] = datetime(2025, 1, 1)
+        index_session(self.sid3, self.session3)
+
+    def _reply(self, if_none_match=None, **form):
+        self.request.form.clear()
+        self.request.form.update(form)
+        self.request["BODY"] = ""
+        self.request["QUERY_STRING"] = ""
+        self.request.environ.pop("HTTP_IF_NONE_MATCH", None)
+        if if_none_match:
+            self.request.environ["HTTP_IF_NONE_MATCH"] = if_none_match
+        return SessionsGet(self.portal, self.request).reply()
+
+    def test_get_sessions(self):
+        ret = self._reply()
+        self.assertEqual(ret["items_total"], 3)
+        # sorted on last update by default
+        self.assertEqual([item["id"] for item in ret["items"]], [self.sid3, self.sid, self.sid2])
+        self.assertEqual(ret["items"][1]["signers"][0]["email"], "user1@sign.com")
+        self.assertEqual(ret["items"][0]["last_update"], "2025-01-01T00:00:00")
+        ret = self._reply(b_size="1", b_start="1", sort_on="id", sort_order="descending")
+        self.assertEqual([item["id"] for item in ret["items"]], [self.sid2])
+        self.assertEqual(ret["items_total"], 3)
+        self.assertIn("next", ret["batching"])
+        # filters
+        self.assertEqual([item["id"] for item in self._reply(state="to_sign")["items"]], [self.sid3])
+        self.assertEqual([item["id"] for item in self._reply(signer="user2")["items"]], [self.sid3])
+        self.assertEqual([item["id"] for item in self._reply(discriminator="other")["items"]], [self.sid2])
+        self.assertEqual([item["id"] for item in self._reply(end="2025-01-02")["items"]], [self.sid3])
+        self.assertEqual(self._reply(start="2025-01-02", state="to_sign")["items"], [])
+        self.assertEqual(self._reply(start="yesterday"), {"message": "Invalid datetime yesterday"})
+        self.assertEqual(self.request.response.getStatus(), 400)
+
+    def test_etag(self):
+        self._reply()
+        etag = self.request.response.getHeader("ETag")
+        self._reply(if_none_match=etag)
+        self.assertEqual(self.request.response.getStatus(), 304)
+        # any session change gives a new etag
+        self.session["state"] = "to_sign"
+        index_session(self.sid, self.session)
+        self.request.response.setStatus(200)
+        self.assertIn("items", self._reply(if_none_match=etag))
+        self.assertNotEqual(self.request.response.getHeader("ETag"), etag)
+        # as registering the app session id
+        etag = self.request.response.getHeader("ETag")
+        register_app_session_id(self.sid)
+        self.assertIn("items", self._reply(if_none_match=etag))
+        self.assertNotEqual(self.request.response.getHeader("ETag"), etag)
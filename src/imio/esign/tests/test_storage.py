@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""storage tests for this package."""
+from imio.esign.storage import EmptySessionStorage
+from imio.esign.storage import EVENTS_LOG_SIZE
+from imio.esign.storage import new_session_storage
+from imio.esign.storage import Session
+from imio.esign.storage import SessionFile
+from imio.esign.storage import SessionFiles
+from persistent.list import PersistentList
+
+import unittest
+
+
+class TestSessionFiles(unittest.TestCase):
+    def _file(self, uid, context_uid="c1"):
+        return SessionFile(
+            uid=uid, context_uid=context_uid, filename="{}.pdf".format(uid), scan_id="012345600000000", title=uid
+        )
+
+    def test_session_files(self):
+        files = SessionFiles([self._file("f1"), self._file("f2")])
+        files.append(self._file("f3", context_uid="c2"))
+        self.assertEqual(len(files), 3)
+        self.assertEqual([f["uid"] for f in files], ["f1", "f2", "f3"])
+        self.assertEqual(files[0]["uid"], "f1")
+        self.assertEqual(files[-1]["uid"], "f3")
+        self.assertIn("f2", files)
+        self.assertEqual(files.get("f3")["context_uid"], "c2")
+        self.assertIsNone(files.get("unknown"))
+        self.assertRaises(ValueError, files.append, self._file("f1"))
+        # removing keeps order
+        self.assertEqual(files.remove("f2")["uid"], "f2")
+        self.assertIsNone(files.remove("f2"))
+        self.assertNotIn("f2", files)
+        files.append(self._file("f2"))
+        self.assertEqual([f["uid"] for f in files], ["f1", "f3", "f2"])
+        # updating keeps order and other fields
+        self.assertEqual(files.update_file("f3", {"sha256": "abc"})["sha256"], "abc")
+        self.assertEqual(files.get("f3")["context_uid"], "c2")
+        self.assertEqual([f["uid"] for f in files], ["f1", "f3", "f2"])
+        self.assertIsNone(files.update_file("unknown", {"sha256": "abc"}))
+        for uid in ("f1", "f2", "f3"):
+            files.remove(uid)
+        self.assertFalse(files)
+
+    def test_get_unique_stem(self):
+        files = SessionFiles()
+        self.assertEqual(files.get_unique_stem("annex"), "annex")
+        files.append(self._file("annex"))
+        self.assertEqual(files.get_unique_stem("annex"), "annex-1")
+        files.append(self._file("annex-1"))
+        self.assertEqual(files.get_unique_stem("annex"), "annex-2")
+        files.append(self._file("annex-2"))
+        # an existing suffixed name is skipped
+        files.append(self._file("annex-3"))
+        self.assertEqual(files.get_unique_stem("annex"), "annex-4")
+        # a removed stem can be used again, removed suffixes are not reused
+        files.remove("annex")
+        files.remove("annex-1")
+        self.assertEqual(files.get_unique_stem("annex"), "annex")
+        files.append(self._file("annex"))
+        self.assertEqual(files.get_unique_stem("annex"), "annex-5")
+
+    def test_old_session_file_state(self):
+        # a file pickled before the sha256 field was added
+        session_file = SessionFile.__new__(SessionFile)
+        session_file.__setstate__(("c1", "annex.pdf", "012345600000000", "Annex", "f1"))
+        self.assertEqual(session_file["uid"], "f1")
+        self.assertIsNone(session_file["sha256"])
+        self.assertIsNone(session_file["blob_version"])
+
+
+class TestSession(unittest.TestCase):
+    def test_get_signer(self):
+        session = Session(
+            signers=PersistentList(
+                [
+                    {"userid": "user1", "email": "user1@sign.com", "fullname": "User 1", "status": ""},
+                    {"userid": None, "email": "ext@sign.com", "fullname": "External", "status": ""},
+                ]
+            )
+        )
+        self.assertEqual(session.get_signer("user1")["fullname"], "User 1")
+        self.assertEqual(session.get_signer("user1@sign.com")["fullname"], "User 1")
+        self.assertEqual(session.get_signer("ext@sign.com")["fullname"], "External")
+        self.assertIsNone(session.get_signer("unknown"))
+        self.assertIsNone(session.get_signer(None))
+        # an old record without index
+        session.signer_index = None
+        self.assertEqual(session.get_signer("ext@sign.com")["fullname"], "External")
+
+    def test_add_event(self):
+        session = Session()
+        for i in range(EVENTS_LOG_SIZE + 5):
+            session.add_event((None, 6, "user1", str(i)))
+        self.assertEqual(len(session["events"]), EVENTS_LOG_SIZE)
+        self.assertEqual(session["events"][0][3], "5")
+        self.assertEqual(session["events"][-1][3], str(EVENTS_LOG_SIZE + 4))
+        # an old record without events
+        del session.events
+        session.add_event((None, 6, "user1", ""))
+        self.assertEqual(len(session["events"]), 1)
+
+
+class TestEmptySessionStorage(unittest.TestCase):
+    def test_read_only(self):
+        storage = EmptySessionStorage()
+        self.assertEqual(sorted(storage), sorted(new_session_storage()))
+        self.assertEqual(storage["count"](), 0)
+        self.assertIsNone(storage["sessions"].get(1))
+        self.assertEqual(list(storage["states"]["draft"]), [])
+        with self.assertRaises(TypeError):
+            storage["sessions"] = None
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""streaming tests for this package."""
+from imio.esign.streaming import detach_blob_file
+from imio.esign.streaming import FilesystemFile
+from imio.esign.streaming import MultipartStream
+from imio.esign.testing import DummyNamedBlobFile
+from imio.esign.testing import StandInServer
+from imio.esign.utils import post_request
+from ZODB.blob import BlobStorage
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
+
+import hashlib
+import os
+import shutil
+import tempfile
+import transaction
+import unittest
+
+
+class DummyNamedFile(object):
+    """Named blob file like object, opening a file on disk."""
+
+    contentType = "application/pdf"
+
+    def __init__(self, path):
+        self.path = path
+        self.opened = 0
+
+    def getSize(self):
+        return os.path.getsize(self.path)
+
+    def open(self):
+        self.opened += 1
+        return open(self.path, "rb")
+
+
+def parse_multipart(body, boundary):
+    """Return the list of (headers, content) parts of a multipart body."""
+    parts = []
+    for part in body.split(b"--" + boundary.encode("ascii"))[1:-1]:
+        headers, content = part[2:-2].split(b"\r\n\r\n", 1)
+        parts.append((headers.split(b"\r\n"), content))
+    return parts
+
+
+class TestMultipartStream(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.files = []
+        for i, size in enumerate((10, 300 * 1024)):
+            path = os.path.join(self.tmpdir, "file{}.pdf".format(i))
+            with open(path, "wb") as fd:
+                fd.write(os.urandom(size))
+            self.files.append(DummyNamedFile(path))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _stream(self, chunk_size=1024):
+        return MultipartStream(
+            fields=[("data", u'{"title": "Sé"}')],
+            files=[("files", u"annexé.pdf", self.files[0]), ("files", "annex.pdf", self.files[1], "code1")],
+            boundary="xXxXx",
+            chunk_size=chunk_size,
+        )
+
+    def _content(self, named_file):
+        with open(named_file.path, "rb") as fd:
+            return fd.read()
+
+    def test_read(self):
+        stream = self._stream()
+        # nothing is read before sending
+        self.assertEqual([f.opened for f in self.files], [0, 0])
+        self.assertEqual(stream.content_type, "multipart/form-data; boundary=xXxXx")
+        chunks = []
+        while True:
+            chunk = stream.read(8192)
+            if not chunk:
+                break
+            self.assertLessEqual(len(chunk), 8192)
+            chunks.append(chunk)
+            self.assertLessEqual(len(stream._buffer), 1024)
+        body = b"".join(chunks)
+        self.assertEqual(len(body), len(stream))
+        self.assertEqual(stream.tell(), len(stream))
+        parts = parse_multipart(body, "xXxXx")
+        self.assertEqual(
+            parts[0], ([b'Content-Disposition: form-data; name="data"'], u'{"title": "Sé"}'.encode("utf8"))
+        )
+        self.assertEqual(
+            parts[1][0],
+            [
+                u'Content-Disposition: form-data; name="files"; filename="annexé.pdf"'.encode("utf8"),
+                b"Content-Type: application/pdf",
+            ],
+        )
+        self.assertEqual(parts[1][1], self._content(self.files[0]))
+        self.assertEqual(parts[2][1], self._content(self.files[1]))
+        # digests of the files given with a key are computed while reading
+        self.assertEqual(stream.hashes, {"code1": hashlib.sha256(self._content(self.files[1])).hexdigest()})
+        # can be rewound to be sent again
+        stream.seek(0)
+        self.assertEqual(stream.read(), body)
+        self.assertRaises(IOError, stream.seek, 10)
+
+    def test_known_hash(self):
+        stream = MultipartStream(files=[("files", "annex.pdf", self.files[1], "code1", "known")], boundary="xXxXx")
+        # a known digest is not computed
+        self.assertEqual(stream.hashes, {"code1": "known"})
+        parts = parse_multipart(stream.read(), "xXxXx")
+        self.assertEqual(parts[0][1], self._content(self.files[1]))
+        self.assertEqual(stream.hashes, {"code1": "known"})
+
+    def test_post_request(self):
+        stream = self._stream()
+        with StandInServer() as server:
+            ret = post_request(server.url + "/sessions", data=stream, headers={"Content-Type": stream.content_type})
+        self.assertEqual(ret.status_code, 200)
+        address, headers, body = server.received[0]
+        headers = {k.lower(): v for k, v in headers.items()}
+        self.assertEqual(headers["content-type"], stream.content_type)
+        self.assertEqual(int(headers["content-length"]), len(stream))
+        self.assertNotIn("transfer-encoding", headers)
+        parts = parse_multipart(body, "xXxXx")
+        self.assertEqual(len(parts), 3)
+        self.assertEqual(parts[2][1], self._content(self.files[1]))
+
+    def test_detach_blob_file(self):
+        # no blob
+        self.assertIs(detach_blob_file(self.files[0]), self.files[0])
+        # committed blob
+        db = DB(BlobStorage(os.path.join(self.tmpdir, "blobs"), MappingStorage()))
+        tm = transaction.TransactionManager()
+        conn = db.open(transaction_manager=tm)
+        try:
+            named_file = DummyNamedBlobFile(b"%PDF-1.4 signed")
+            conn.root()["file"] = named_file
+            # uncommitted blob
+            self.assertIs(detach_blob_file(named_file), named_file)
+            tm.commit()
+            named_file._p_deactivate()
+            named_file._blob._p_deactivate()
+            detached = detach_blob_file(named_file)
+            self.assertIsInstance(detached, FilesystemFile)
+            self.assertEqual(detached.contentType, "application/pdf")
+            tm.abort()
+        finally:
+            conn.close()
+            db.close()
+        # the committed file is read without the connection
+        self.assertEqual(detached.getSize(), 15)
+        with detached.open() as fd:
+            self.assertEqual(fd.read(), b"%PDF-1.4 signed")
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""upgrades tests for this package."""
+from BTrees.Length import Length
+from datetime import datetime
+from imio.esign.interfaces import IEsignContext
+from imio.esign.interfaces import IEsignFile
+from imio.esign.storage import Session
+from imio.esign.storage import SessionFiles
+from imio.esign.testing import add_annexes
+from imio.esign.testing import IMIO_ESIGN_INTEGRATION_TESTING
+from imio.esign.upgrades import migrate_session_storage
+from imio.esign.upgrades import upgrade_to_1002
+from imio.esign.utils import add_files_to_session
+from imio.esign.utils import discriminate_sessions
+from imio.esign.utils import get_session_annotation
+from imio.esign.utils import get_session_id_from_app_session_id
+from imio.esign.utils import get_session_ids
+from persistent.list import PersistentList
+from persistent.mapping import PersistentMapping
+from plone import api
+from plone.app.testing import setRoles
+from plone.app.testing import TEST_USER_ID
+from zope.annotation import IAnnotations
+from zope.interface import noLongerProvides
+
+import unittest
+
+
+class TestUpgrades(unittest.TestCase):
+
+    layer = IMIO_ESIGN_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+
+    def _old_file(self, uid, context_uid, filename):
+        return {
+            "scan_id": "012345600000001",
+            "filename": filename,
+            "title": "Annex {}".format(uid),
+            "uid": uid,
+            "context_uid": context_uid,
+        }
+
+    def _old_session(self, files, state="draft", seal=None):
+        return {
+            "acroform": True,
+            "client_id": "0123456",
+            "discriminators": ("disc",),
+            "files": PersistentList(files),
+            "last_update": datetime(2025, 1, 1),
+            "seal": seal,
+            "sign_url": None,
+            "signers": PersistentList(
+                [{"userid": "user1", "email": "user1@sign.com", "fullname": "User 1", "position": "P1", "status": ""}]
+            ),
+            "state": state,
+            "title": "Session",
+        }
+
+    def test_migrate_session_storage(self):
+        self.assertIsNone(migrate_session_storage(self.portal))
+        old = PersistentMapping(
+            {
+                "numbering": 2,
+                "sessions": PersistentMapping(
+                    {
+                        0: self._old_session(
+                            [self._old_file("f1", "c1", "annex.pdf"), self._old_file("f2", "c1", "annex-1.pdf")]
+                        ),
+                        1: self._old_session([self._old_file("f3", "c2", "annex.pdf")], state="sent", seal="seal"),
+                    }
+                ),
+                "uids": PersistentMapping({"f1": 0, "f2": 0, "f3": 1}),
+                "c_uids": PersistentMapping({"c1": PersistentList(["f1", "f2"]), "c2": PersistentList(["f3"])}),
+            }
+        )
+        IAnnotations(self.portal)["imio.esign"] = old
+        self.assertEqual(migrate_session_storage(self.portal), 2)
+        annot = get_session_annotation()
+        self.assertIsNot(annot, old)
+        self.assertIsInstance(annot["numbering"], Length)
+        self.assertEqual(annot["numbering"](), 2)
+        self.assertEqual(annot["count"](), 2)
+        session = annot["sessions"][0]
+        self.assertIsInstance(session, Session)
+        self.assertIsInstance(session["files"], SessionFiles)
+        self.assertEqual([f["filename"] for f in session["files"]], ["annex.pdf", "annex-1.pdf"])
+        self.assertEqual(session["files"].get("f2")["title"], "Annex f2")
+        self.assertEqual(session["files"].get_unique_stem("annex"), "annex-2")
+        self.assertEqual(session["discriminators"], ("disc",))
+        self.assertEqual(session.get_signer("user1@sign.com")["fullname"], "User 1")
+        self.assertEqual(dict(annot["uids"]), {"f1": 0, "f2": 0, "f3": 1})
+        self.assertEqual(list(annot["c_uids"]["c1"]), ["f1", "f2"])
+        self.assertEqual(list(annot["c_uids"]["c2"]), ["f3"])
+        # sessions are indexed
+        self.assertEqual(list(get_session_ids(states=["draft"])), [0])
+        self.assertEqual(list(get_session_ids(states=["sent"])), [1])
+        self.assertEqual(list(get_session_ids(signer="user1")), [0, 1])
+        self.assertEqual(list(get_session_ids(discriminator="disc")), [0, 1])
+        signers = [("user1", "user1@sign.com", "User 1", "P1")]
+        self.assertEqual(discriminate_sessions(signers, None, True, discriminators=("disc",))[0], 0)
+        self.assertEqual(discriminate_sessions(signers, "seal", True, discriminators=("disc",)), (None, None))
+        # the sent session can receive feedbacks
+        self.assertIsNone(session["app_session_id"])
+        self.assertEqual(get_session_id_from_app_session_id(annot["sessions"][1]["app_session_id"]), 1)
+        # converting again does nothing
+        self.assertIsNone(migrate_session_storage(self.portal))
+        self.assertIs(get_session_annotation(), annot)
+
+    def test_upgrade_to_1002(self):
+        setRoles(self.portal, TEST_USER_ID, ["Manager"])
+        folders, uids = add_annexes(self.portal, count=2)
+        sid, session = add_files_to_session([("user1", "user1@sign.com", "User 1", "P1")], uids)
+        # files and contexts added before the index existed
+        catalog = api.portal.get_tool("portal_catalog")
+        catalog.delIndex("esign_session_ids")
+        annexes = [api.content.get(UID=uid) for uid in uids]
+        for obj, interface in [(annex, IEsignFile) for annex in annexes] + [(f, IEsignContext) for f in folders]:
+            noLongerProvides(obj, interface)
+        upgrade_to_1002(api.portal.get_tool("portal_setup"))
+        self.assertIn("esign_session_ids", catalog.indexes())
+        self.assertTrue(all(IEsignFile.providedBy(annex) for annex in annexes))
+        self.assertTrue(all(IEsignContext.providedBy(folder) for folder in folders))
+        self.assertEqual(
+            sorted(brain.UID for brain in catalog.unrestrictedSearchResults(esign_session_ids=sid)),
+            sorted(uids + [folder.UID() for folder in folders]),
+        )
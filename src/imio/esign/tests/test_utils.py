@@ -1,20 +1,56 @@
 # -*- coding: utf-8 -*-
 """utils tests for this package."""
+from BTrees.IOBTree import IOBTree
+from BTrees.OOBTree import OOBTree
+from datetime import datetime
+from imio.esign.adapters import FilesBelongingToAGivenSession
+from imio.esign.interfaces import IEsignContext
+from imio.esign.interfaces import IEsignFile
+from imio.esign.storage import new_session_storage
+from imio.esign.storage import Session
+from imio.esign.storage import SessionFile
+from imio.esign.storage import SessionFiles
+from imio.esign.streaming import blob_version
+from imio.esign.streaming import detach_blob_file
+from imio.esign.streaming import MultipartStream
+from imio.esign.testing import add_annexes
+from imio.esign.testing import DummyNamedBlobFile
 from imio.esign.testing import IMIO_ESIGN_INTEGRATION_TESTING  # noqa: E501
+from imio.esign.utils import _reserve_session_ids
 from imio.esign.utils import add_files_to_session
+from imio.esign.utils import create_session
+from imio.esign.utils import discriminate_sessions
+from imio.esign.utils import get_readonly_session_annotation
+from imio.esign.utils import get_request_session
 from imio.esign.utils import get_session_annotation
+from imio.esign.utils import get_session_id_from_app_session_id
+from imio.esign.utils import get_session_ids
+from imio.esign.utils import get_sessions_batch
+from imio.esign.utils import get_stored_file_hash
+from imio.esign.utils import index_session
+from imio.esign.utils import register_app_session_id
+from imio.esign.utils import register_files_hashes
 from imio.esign.utils import remove_context_from_session
 from imio.esign.utils import remove_files_from_session
 from imio.esign.utils import remove_session
+from imio.esign.utils import SESSION_IDS_BLOCK
 from plone import api
 from plone.app.testing import setRoles
 from plone.app.testing import TEST_USER_ID
-from plone.namedfile.file import NamedBlobFile
-from plone.namedfile.file import NamedBlobImage
+from plone.indexer.interfaces import IIndexer
+from ZODB.blob import BlobStorage
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.MappingStorage import MappingStorage
+from ZODB.POSException import ConflictError
 from zope.annotation import IAnnotations
+from zope.component import queryMultiAdapter
 
-import collective.iconifiedcategory
+import hashlib
 import os
+import shutil
+import tempfile
+import transaction
 import unittest
 
 
@@ -28,64 +64,7 @@ class TestUtils(unittest.TestCase):
         # add some users
         api.user.create(email="user1@sign.com", username="user1", password="password1")
         api.user.create(email="user2@sign.com", username="user2", password="password2")
-        # add content category configuration
-        at_folder = api.content.create(
-            container=self.portal,
-            id="annexes_types",
-            title="Annexes Types",
-            type="ContentCategoryConfiguration",
-            exclude_from_nav=True,
-        )
-        category_group = api.content.create(
-            type="ContentCategoryGroup",
-            title="Annexes",
-            container=at_folder,
-            id="annexes",
-        )
-        icon_path = os.path.join(os.path.dirname(collective.iconifiedcategory.__file__), "tests", "icône1.png")
-        with open(icon_path, "rb") as fl:
-            api.content.create(
-                type="ContentCategory",
-                title="To sign",
-                container=category_group,
-                icon=NamedBlobImage(fl.read(), filename=u"icône1.png"),
-                id="to_sign",
-                predefined_title="To be signed",
-                # confidential=True,
-                # to_print=True,
-                to_sign=True,
-                # signed=True,
-                # publishable=True,
-                # only_pdf=True,
-                show_preview=False,
-            )
-        # add annexes
-        self.folders = []
-        for f in range(2):
-            folder = api.content.create(
-                container=self.portal,
-                id="folder{}".format(f),
-                title="Folder {}".format(f),
-                type="Folder",
-            )
-            self.folders.append(folder)
-        tests_dir = os.path.dirname(__file__)
-        pdf_files = ["annex1.pdf", "annex2.pdf"]
-        self.uids = []
-        for i in range(10):
-            pdf_file = pdf_files[i % len(pdf_files)]
-            container = self.folders[i % len(self.folders)]
-            with open(os.path.join(tests_dir, pdf_file), "rb") as f:
-                annex = api.content.create(
-                    container=container,
-                    type="annex",
-                    id="annex{}".format(i),
-                    title="Annex {}".format(i),
-                    content_category="to_sign",
-                    scan_id="0123456000000{:02d}".format(i),
-                    file=NamedBlobFile(data=f.read(), filename=u"annex{}.pdf".format(i), contentType="application/pdf"),
-                )
-                self.uids.append(annex.UID())
+        self.folders, self.uids = add_annexes(self.portal)
 
     def test_add_remove_files_to_session(self):
         root_annot = IAnnotations(self.portal)
@@ -97,13 +76,20 @@ class TestUtils(unittest.TestCase):
         # add files, no session_id, no discriminator
         sid, session = add_files_to_session(signers, (self.uids[0],), title="my title")
         self.assertEqual(sid, 0)
+        sids = [sid]
         annot = root_annot["imio.esign"]
-        self.assertEqual(annot["numbering"], 1)
+        self.assertIsInstance(annot["sessions"], IOBTree)
+        self.assertIsInstance(annot["uids"], OOBTree)
+        self.assertIsInstance(annot["c_uids"], OOBTree)
+        self.assertIsInstance(session, Session)
+        self.assertIsInstance(session["files"], SessionFiles)
+        self.assertEqual(annot["numbering"](), 10)
         self.assertEqual(len(annot["sessions"]), 1)
         self.assertEqual(len(annot["uids"]), 1)
         self.assertIn(self.uids[0], annot["uids"])
         self.assertEqual(len(annot["c_uids"][self.folders[0].UID()]), 1)
-        self.assertDictEqual(dict(annot["c_uids"]), {self.folders[0].UID(): [self.uids[0]]})
+        self.assertListEqual(list(annot["c_uids"].keys()), [self.folders[0].UID()])
+        self.assertListEqual(list(annot["c_uids"][self.folders[0].UID()]), [self.uids[0]])
         self.assertEqual(session["title"], "my title")
         self.assertEqual(session["state"], "draft")
         self.assertEqual(session["seal"], None)
@@ -111,8 +97,9 @@ class TestUtils(unittest.TestCase):
         self.assertIsNone(session["sign_url"])
         self.assertEqual(session["client_id"], "0123456")
         self.assertEqual(len(session["files"]), 1)
+        self.assertIsInstance(session["files"][0], SessionFile)
         self.assertListEqual(
-            list(session["files"]),
+            [dict(f) for f in session["files"]],
             [
                 {
                     "context_uid": self.folders[0].UID(),
@@ -120,6 +107,8 @@ class TestUtils(unittest.TestCase):
                     "title": "Annex 0",
                     "uid": self.uids[0],
                     "filename": "annex0.pdf",
+                    "sha256": None,
+                    "blob_version": None,
                 }
             ],
         )
@@ -127,8 +116,8 @@ class TestUtils(unittest.TestCase):
         # add files, no session_id => same session reused
         signers[1] = ("user2", "user2@sign.com", "User 2", "Position 2b")  # changed position => not discriminant
         sid, session = add_files_to_session(signers, (self.uids[1],))
-        self.assertEqual(sid, 0)
-        self.assertEqual(annot["numbering"], 1)
+        self.assertEqual(sid, sids[0])
+        self.assertEqual(annot["numbering"](), 10)
         self.assertEqual(len(annot["sessions"]), 1)
         self.assertEqual(len(annot["uids"]), 2)
         self.assertIn(self.uids[1], annot["uids"])
@@ -138,59 +127,69 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(len(annot["c_uids"][self.folders[1].UID()]), 1)
         # add files, no session_id, new discriminations => new session
         sid, session = add_files_to_session(signers, (self.uids[2],), discriminators=("council1",))
-        self.assertEqual(sid, 1)
-        self.assertEqual(annot["numbering"], 2)
+        self.assertNotIn(sid, sids)
+        sids.append(sid)
+        self.assertEqual(annot["numbering"](), 10)
         self.assertEqual(len(annot["sessions"]), 2)
         self.assertEqual(len(annot["uids"]), 3)
         self.assertIn(self.uids[2], annot["uids"])
         self.assertEqual(len(session["files"]), 1)
         # add files, no session_id, same discriminations => same session
         sid, session = add_files_to_session(signers, (self.uids[3],), discriminators=("council1",))
-        self.assertEqual(sid, 1)
-        self.assertEqual(annot["numbering"], 2)
+        self.assertEqual(sid, sids[1])
+        self.assertEqual(annot["numbering"](), 10)
         self.assertEqual(len(annot["sessions"]), 2)
         self.assertEqual(len(annot["uids"]), 4)
         self.assertIn(self.uids[3], annot["uids"])
         self.assertEqual(len(session["files"]), 2)
         # add files, no session_id, other discriminations => other session
         sid, session = add_files_to_session(signers, (self.uids[4],), discriminators=("council2",))
-        self.assertEqual(sid, 2)
+        self.assertNotIn(sid, sids)
+        sids.append(sid)
         # add files, session_id, other discriminations => reused session
-        sid, session = add_files_to_session(signers, (self.uids[5],), session_id=0, discriminators=("council3",))
-        self.assertEqual(sid, 0)
+        sid, session = add_files_to_session(signers, (self.uids[5],), session_id=sids[0], discriminators=("council3",))
+        self.assertEqual(sid, sids[0])
         # add files, session_id unfound, other discriminations => new session
-        sid, session = add_files_to_session(signers, (self.uids[6],), session_id=999, discriminators=("council3",))
-        self.assertEqual(sid, 3)
+        sid, session = add_files_to_session(signers, (self.uids[6],), session_id=-1, discriminators=("council3",))
+        self.assertNotIn(sid, sids)
+        sids.append(sid)
         # add files, no session_id, different signers => new session
         sid, session = add_files_to_session([signers[0]], (self.uids[7],))
-        self.assertEqual(sid, 4)
+        self.assertNotIn(sid, sids)
+        sids.append(sid)
         # add files, no session_id, different seal => new session
         sid, session = add_files_to_session(signers, (self.uids[8],), seal="seal1")
-        self.assertEqual(sid, 5)
+        self.assertNotIn(sid, sids)
+        sids.append(sid)
         # add files, no session_id, same seal, different acroform => new session
         sid, session = add_files_to_session(signers, (self.uids[9],), acroform=False)
-        self.assertEqual(sid, 6)
+        self.assertNotIn(sid, sids)
+        sids.append(sid)
 
         self.assertEqual(len(annot["uids"]), 10)
         self.assertEqual(len(annot["c_uids"]), 2)
+        self.assertEqual(len(annot["discriminations"]), 7)
         self.assertEqual(len(annot["c_uids"][self.folders[0].UID()]), 5)
         self.assertEqual(len(annot["c_uids"][self.folders[1].UID()]), 5)
         self.assertEqual(len(annot["sessions"]), 7)
+        # ids are sequential, from the block of ids reserved by the connection
+        self.assertListEqual(sids, list(range(7)))
+        self.assertEqual(annot["numbering"](), 10)
 
         # now we can start to remove
         remove_files_from_session((self.uids[0], self.uids[1]))  # 2 of 3 session files
         self.assertEqual(len(annot["uids"]), 8)
-        self.assertEqual(len(annot["sessions"][0]["files"]), 1)
+        self.assertEqual(len(annot["sessions"][sids[0]]["files"]), 1)
         self.assertEqual(len(annot["c_uids"][self.folders[0].UID()]), 4)
         self.assertEqual(len(annot["c_uids"][self.folders[1].UID()]), 4)
         remove_files_from_session((self.uids[5],))  # no more session files, session removed
         self.assertEqual(len(annot["uids"]), 7)
         self.assertEqual(len(annot["sessions"]), 6)
-        self.assertNotIn(0, annot["sessions"])
+        self.assertNotIn(sids[0], annot["sessions"])
         remove_files_from_session((self.uids[2], self.uids[3]))  # all session files, session removed
         self.assertEqual(len(annot["uids"]), 5)
         self.assertEqual(len(annot["sessions"]), 5)
-        self.assertNotIn(1, annot["sessions"])
+        self.assertNotIn(sids[1], annot["sessions"])
         remove_files_from_session((self.uids[4],))
         remove_files_from_session((self.uids[6],))
         remove_files_from_session((self.uids[7],))
@@ -199,6 +198,58 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(len(annot["uids"]), 0)
         self.assertEqual(len(annot["c_uids"]), 0)
         self.assertEqual(len(annot["sessions"]), 0)
+        self.assertEqual(len(annot["discriminations"]), 0)
+
+    def test_add_files_to_session_catalog_queries(self):
+        """Test that files are resolved with one catalog query, whatever their number."""
+        signers = [("user1", "user1@sign.com", "User 1", "Position 1")]
+        catalog = api.portal.get_tool("portal_catalog")
+        queries = []
+        search = catalog.unrestrictedSearchResults
+
+        def counting_search(*args, **kwargs):
+            queries.append(kwargs)
+            return search(*args, **kwargs)
+
+        catalog.unrestrictedSearchResults = counting_search
+        try:
+            sid, session = add_files_to_session(signers, self.uids + ["unknown_uid"])
+        finally:
+            del catalog.unrestrictedSearchResults
+        self.assertEqual(len(queries), 1)
+        self.assertEqual([f["uid"] for f in session["files"]], self.uids)
+
+    def test_add_files_to_session_twice(self):
+        """Test that files already in the session are not added again."""
+        signers = [("user1", "user1@sign.com", "User 1", "Position 1")]
+        sid, session = add_files_to_session(signers, self.uids[:2])
+        sid2, session = add_files_to_session(signers, [self.uids[1], self.uids[2], self.uids[2]])
+        self.assertEqual(sid2, sid)
+        self.assertEqual([f["uid"] for f in session["files"]], self.uids[:3])
+        self.assertEqual([f["filename"] for f in session["files"]], ["annex0.pdf", "annex1.pdf", "annex2.pdf"])
+        self.assertEqual(get_session_annotation()["uids"][self.uids[2]], sid)
+
+    def test_discriminate_sessions(self):
+        """Test that only draft sessions with same discrimination values are found."""
+        annot = get_session_annotation()
+        signers = [
+            ("user1", "user1@sign.com", "User 1", "Position 1"),
+            ("user2", "user2@sign.com", "User 2", "Position 2"),
+        ]
+        self.assertEqual(discriminate_sessions(signers, None, True), (None, None))
+        sid, session = add_files_to_session(signers, (self.uids[0],), discriminators=("council1", "item"))
+        self.assertEqual(discriminate_sessions(signers, None, True, ("item", "council1")), (sid, session))
+        self.assertEqual(discriminate_sessions(signers, None, True), (None, None))
+        self.assertEqual(discriminate_sessions(signers, "seal1", True, ("council1", "item")), (None, None))
+        self.assertEqual(discriminate_sessions(signers, None, False, ("council1", "item")), (None, None))
+        self.assertEqual(discriminate_sessions(list(reversed(signers)), None, True, ("council1", "item")), (None, None))
+        # a session that is no more in draft is not discriminated anymore
+        session["state"] = "to_sign"
+        index_session(sid, session)
+        self.assertEqual(len(annot["discriminations"]), 0)
+        self.assertEqual(discriminate_sessions(signers, None, True, ("council1", "item")), (None, None))
+        sid2, session2 = add_files_to_session(signers, (self.uids[1],), discriminators=("council1", "item"))
+        self.assertNotEqual(sid2, sid)
 
     def test_add_files_with_duplicate_filenames(self):
         """Test that files with duplicate filenames are renamed with suffix."""
@@ -257,15 +308,305 @@ class TestUtils(unittest.TestCase):
             ("user1", "user1@sign.com", "User 1", "Position 1"),
             ("user2", "user2@sign.com", "User 2", "Position 2"),
         ]
-        sid, session = add_files_to_session(signers, (self.uids[0], self.uids[1]))
-        self.assertEqual(sid, 0)
-        sid, session = add_files_to_session(signers, (self.uids[2], self.uids[3]), seal="seal1")
-        self.assertEqual(sid, 1)
-        remove_session(0)  # remove first session
+        sid0, session = add_files_to_session(signers, (self.uids[0], self.uids[1]))
+        sid1, session = add_files_to_session(signers, (self.uids[2], self.uids[3]), seal="seal1")
+        self.assertNotEqual(sid0, sid1)
+        remove_session(sid0)  # remove first session
         self.assertEqual(len(annot["uids"]), 2)
         self.assertEqual(len(annot["c_uids"]), 2)
         self.assertEqual(len(annot["sessions"]), 1)
 
+    def test_esign_session_ids_index(self):
+        catalog = api.portal.get_tool("portal_catalog")
+        signers = [("user1", "user1@sign.com", "User 1", "Position 1")]
+        sid0, session0 = add_files_to_session(signers, (self.uids[0], self.uids[1]))
+        sid1, session1 = add_files_to_session(signers, (self.uids[2],), seal="seal1")
+
+        def indexed(session_id):
+            return sorted(brain.UID for brain in catalog.unrestrictedSearchResults(esign_session_ids=session_id))
+
+        folder0, folder1 = self.folders[0].UID(), self.folders[1].UID()
+        self.assertEqual(indexed(sid0), sorted([self.uids[0], self.uids[1], folder0, folder1]))
+        self.assertEqual(indexed(sid1), sorted([self.uids[2], folder0]))
+        # only annexes and contexts of files are indexed
+        self.assertTrue(IEsignContext.providedBy(self.folders[0]))
+        self.assertTrue(IEsignFile.providedBy(api.content.get(UID=self.uids[0])))
+        self.assertIsNone(queryMultiAdapter((self.portal, catalog), IIndexer, name="esign_session_ids"))
+        # the compound criterion queries the index
+        self.portal.REQUEST.form["esign_session_id"] = str(sid1)
+        adapter = FilesBelongingToAGivenSession(self.portal)
+        self.assertEqual(adapter.query, {"esign_session_ids": {"query": [sid1]}})
+        self.portal.REQUEST.form["esign_session_id"] = "unknown"
+        self.assertEqual(adapter.query, {"UID": {"query": []}})
+        # removals update the index
+        remove_files_from_session([self.uids[0]])
+        self.assertEqual(indexed(sid0), sorted([self.uids[1], folder1]))
+        self.assertEqual(indexed(sid1), sorted([self.uids[2], folder0]))
+        remove_session(sid1)
+        self.assertEqual(indexed(sid1), [])
+        remove_context_from_session((folder1,))
+        self.assertEqual(indexed(sid0), [])
+
+    def test_get_readonly_session_annotation(self):
+        root_annot = IAnnotations(self.portal)
+        self.assertEqual(get_readonly_session_annotation()["count"](), 0)
+        self.assertEqual(get_sessions_batch(), (0, []))
+        self.assertEqual(len(get_session_ids(states=["draft"])), 0)
+        self.assertIsNone(get_session_id_from_app_session_id("1001"))
+        self.assertIsNone(get_request_session("1", self.portal.REQUEST))
+        self.portal.restrictedTraverse("@@esign-sessions-listing")()
+        # reading never creates the storage
+        self.assertNotIn("imio.esign", root_annot)
+        create_session([("user1", "user1@sign.com", "User 1", "Position 1")], None)
+        self.assertIs(get_readonly_session_annotation(), root_annot["imio.esign"])
+
+    def test_get_sessions_batch(self):
+        annot = get_session_annotation()
+        sids = []
+        for i in range(5):
+            sid, session = create_session([("user1", "user1@sign.com", "User 1", "Position 1")], "seal{}".format(i))
+            session["state"] = ("draft", "to_sign")[i % 2]
+            session["last_update"] = datetime(2025, 1, 1 + i)
+            index_session(sid, session)
+            sids.append(sid)
+        self.assertEqual(annot["count"](), 5)
+        total, sessions = get_sessions_batch(b_start=1, b_size=2, sort_on="id")
+        self.assertEqual(total, 5)
+        self.assertEqual([sid for sid, session in sessions], sorted(sids)[1:3])
+        total, sessions = get_sessions_batch(b_start=3, b_size=5, sort_on="id", reverse=True)
+        self.assertEqual([sid for sid, session in sessions], sorted(sids, reverse=True)[3:])
+        total, sessions = get_sessions_batch(b_size=2, sort_on="last_update", reverse=True)
+        self.assertEqual([sid for sid, session in sessions], [sids[4], sids[3]])
+        total, sessions = get_sessions_batch(sort_on="last_update", state="to_sign")
+        self.assertEqual(total, 2)
+        self.assertEqual([sid for sid, session in sessions], [sids[1], sids[3]])
+        # filtered without state, sorted on state
+        total, sessions = get_sessions_batch(sort_on="state", signer="user1")
+        self.assertEqual(
+            [sid for sid, session in sessions], sorted([sids[0], sids[2], sids[4]]) + sorted([sids[1], sids[3]])
+        )
+        # a session without last update is sorted first
+        session = annot["sessions"][sids[2]]
+        session["last_update"] = None
+        index_session(sids[2], session)
+        total, sessions = get_sessions_batch(sort_on="last_update")
+        self.assertEqual(total, 5)
+        self.assertEqual([sid for sid, session in sessions], [sids[2], sids[0], sids[1], sids[3], sids[4]])
+        total, sessions = get_sessions_batch(b_size=2, sort_on="last_update", reverse=True, signer="user1")
+        self.assertEqual(total, 5)
+        self.assertEqual([sid for sid, session in sessions], [sids[4], sids[3]])
+        self.assertRaises(ValueError, get_sessions_batch, sort_on="title")
+        remove_session(sids[0])
+        self.assertEqual(get_sessions_batch()[0], 4)
+
+    def test_state_and_last_update_indexes(self):
+        annot = get_session_annotation()
+        signers = [("user1", "user1@sign.com", "User 1", "Position 1")]
+        sid0, session0 = add_files_to_session(signers, (self.uids[0], self.uids[1]))
+        sid1, session1 = add_files_to_session(signers, (self.uids[2],), seal="seal1")
+        self.assertEqual(list(annot["states"]["draft"]), sorted([sid0, sid1]))
+        self.assertEqual(annot["indexed"][sid0], ("draft", session0["last_update"]))
+        self.assertIn((session0["last_update"], sid0), annot["last_updates"])
+        session1["state"] = "to_sign"
+        session1["last_update"] = datetime(2025, 1, 1)
+        index_session(sid1, session1)
+        self.assertEqual(list(annot["states"]["draft"]), [sid0])
+        self.assertEqual(list(annot["states"]["to_sign"]), [sid1])
+        self.assertEqual(list(get_session_ids(states=["to_sign"])), [sid1])
+        self.assertEqual(list(get_session_ids(end=datetime(2025, 1, 2))), [sid1])
+        self.assertEqual(list(get_session_ids(states=["draft"], end=datetime(2025, 1, 2))), [])
+        self.assertEqual(len(get_session_ids()), 2)
+        # removing files updates the indexes
+        remove_files_from_session([self.uids[0]])
+        self.assertEqual(annot["indexed"][sid0], ("draft", session0["last_update"]))
+        self.assertEqual(len(annot["last_updates"]), 2)
+        remove_files_from_session([self.uids[1]])
+        remove_session(sid1)
+        self.assertFalse(any(annot["states"].values()))
+        self.assertEqual(len(annot["last_updates"]), 0)
+        self.assertEqual(len(annot["indexed"]), 0)
+        self.assertEqual(len(annot["signers"]), 0)
+        self.assertEqual(annot["count"](), 0)
+
+    def test_app_session_id(self):
+        annot = get_session_annotation()
+        signers = [("user1", "user1@sign.com", "User 1", "Position 1")]
+        sid, session = add_files_to_session(signers, (self.uids[0],))
+        self.assertIsNone(session["app_session_id"])
+        self.assertIsNone(get_session_id_from_app_session_id("01234561"))
+        app_session_id = register_app_session_id(sid)
+        self.assertEqual(session["app_session_id"], app_session_id)
+        # registering again keeps the same id
+        self.assertEqual(register_app_session_id(sid), app_session_id)
+        self.assertEqual(len(annot["app_session_ids"]), 1)
+        # the id is received as string or int
+        self.assertEqual(get_session_id_from_app_session_id(app_session_id), sid)
+        self.assertEqual(get_session_id_from_app_session_id(str(app_session_id)), sid)
+        remove_session(sid)
+        self.assertIsNone(get_session_id_from_app_session_id(app_session_id))
+        self.assertEqual(len(annot["app_session_ids"]), 0)
+
+
+class TestConcurrentSessionCreation(unittest.TestCase):
+    """Test session creation from concurrent transactions, as done by several threads or ZEO clients."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = DB(FileStorage(os.path.join(self.tmpdir, "Data.fs")))
+        tm = transaction.TransactionManager()
+        conn = self.db.open(tm)
+        conn.root()["imio.esign"] = new_session_storage()
+        tm.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _open_connections(self, count):
+        """Open connections having each reserved its block of session ids in its own transaction."""
+        managers = [transaction.TransactionManager() for i in range(count)]
+        connections = [self.db.open(tm) for tm in managers]
+        for tm, conn in zip(managers, connections):
+            tm.begin()
+            _reserve_session_ids(conn.root()["imio.esign"])
+            tm.commit()
+        return managers, connections
+
+    def test_parallel_create_session(self):
+        managers, connections = self._open_connections(3)
+        sids = []
+        for i, conn in enumerate(connections):
+            signers = [("user{}".format(i), "user{}@sign.com".format(i), "User {}".format(i), "Position")]
+            sid, session = create_session(signers, None, annot=conn.root()["imio.esign"])
+            sids.append(sid)
+        # all transactions commit without any ConflictError
+        for tm in managers:
+            tm.commit()
+        for conn in connections:
+            conn.close()
+        self.assertEqual(sids, [0, SESSION_IDS_BLOCK, 2 * SESSION_IDS_BLOCK])
+        tm = transaction.TransactionManager()
+        conn = self.db.open(tm)
+        annot = conn.root()["imio.esign"]
+        self.assertEqual(annot["numbering"](), 3 * SESSION_IDS_BLOCK)
+        self.assertEqual(sorted(annot["sessions"].keys()), sorted(sids))
+        self.assertEqual(len(annot["discriminations"]), 3)
+        self.assertEqual(sorted(annot["states"]["draft"]), sorted(sids))
+        tm.abort()
+        conn.close()
+
+    def test_parallel_reserve_same_block(self):
+        managers = [transaction.TransactionManager() for i in range(2)]
+        connections = [self.db.open(tm) for tm in managers]
+        annots = [conn.root()["imio.esign"] for conn in connections]
+        signers = [("user0", "user0@sign.com", "User 0", "Position")]
+        for annot in annots:
+            self.assertEqual(create_session(signers, None, annot=annot)[0], 0)
+        managers[0].commit()
+        self.assertRaises(ConflictError, managers[1].commit)
+        # the retried transaction uses the next id of the block
+        managers[1].abort()
+        self.assertEqual(create_session(signers, "seal1", annot=annots[1])[0], 1)
+        managers[1].commit()
+        # the other connection drops the block when meeting the used id
+        managers[0].begin()
+        self.assertEqual(create_session(signers, "seal2", annot=annots[0])[0], SESSION_IDS_BLOCK)
+        managers[0].commit()
+        for conn in connections:
+            conn.close()
+
+    def test_parallel_create_session_shared_signer(self):
+        managers, connections = self._open_connections(3)
+        signers = [("user0", "user0@sign.com", "User 0", "Position")]
+        sids = []
+        for i, conn in enumerate(connections):
+            # two sessions have a same new discrimination key, the other a different seal
+            seal = "seal1" if i == 1 else None
+            sid, session = create_session(signers, seal, annot=conn.root()["imio.esign"], discriminators=("d1",))
+            sids.append(sid)
+        # all transactions commit without any ConflictError
+        for tm in managers:
+            tm.commit()
+        for conn in connections:
+            conn.close()
+        self.assertEqual(len(set(sids)), 3)
+        tm = transaction.TransactionManager()
+        conn = self.db.open(tm)
+        annot = conn.root()["imio.esign"]
+        self.assertEqual(sorted(annot["sessions"].keys()), sorted(sids))
+        self.assertEqual(len(annot["discriminations"]), 3)
+        self.assertEqual(sorted(get_session_ids(signer="user0", annot=annot)), sorted(sids))
+        self.assertEqual(sorted(get_session_ids(discriminator="d1", annot=annot)), sorted(sids))
+        tm.abort()
+        conn.close()
+
+
+class TestFileHash(unittest.TestCase):
+    """Test the files digests stored with the blob version they were computed from, with committed blobs."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = DB(BlobStorage(os.path.join(self.tmpdir, "blobs"), MappingStorage()))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _send(self, session, named_file):
+        """Read a request body with the file, as done when sending it."""
+        stream = MultipartStream(
+            files=[
+                (
+                    "files",
+                    "annex.pdf",
+                    detach_blob_file(named_file),
+                    ("012345600000000", blob_version(named_file)),
+                    get_stored_file_hash(session["files"].get("f1"), named_file),
+                )
+            ]
+        )
+        stream.read()
+        return stream.hashes
+
+    def test_get_stored_file_hash(self):
+        tm = transaction.TransactionManager()
+        conn = self.db.open(tm)
+        root = conn.root()
+        annot = root["imio.esign"] = new_session_storage()
+        named_file = root["file"] = DummyNamedBlobFile(b"%PDF-1.4 version 1")
+        session_file = SessionFile(
+            uid="f1", context_uid="c1", filename="annex.pdf", scan_id="012345600000000", title="Annex"
+        )
+        session = annot["sessions"][0] = Session(files=SessionFiles([session_file]))
+        # uncommitted blob has no version
+        self.assertIsNone(blob_version(named_file))
+        self.assertIsNone(get_stored_file_hash(session_file, named_file))
+        tm.commit()
+        version = blob_version(named_file)
+        self.assertEqual(version, (named_file._blob._p_oid, named_file._blob._p_serial))
+        sha1 = hashlib.sha256(b"%PDF-1.4 version 1").hexdigest()
+        self.assertEqual(self._send(session, named_file), {("012345600000000", version): sha1})
+        register_files_hashes(0, {("012345600000000", version): sha1}, annot=annot)
+        self.assertEqual(session["files"].get("f1")["blob_version"], version)
+        self.assertEqual(get_stored_file_hash(session["files"].get("f1"), named_file), sha1)
+        # the stored digest is used, and not computed again, while the file is not changed
+        session["files"].update_file("f1", {"sha256": "stored"})
+        tm.commit()
+        self.assertEqual(self._send(session, named_file), {("012345600000000", version): "stored"})
+        # a new version is hashed again
+        with named_file._blob.open("w") as fd:
+            fd.write(b"%PDF-1.4 version 2")
+        tm.commit()
+        self.assertNotEqual(blob_version(named_file), version)
+        self.assertIsNone(get_stored_file_hash(session["files"].get("f1"), named_file))
+        self.assertEqual(
+            self._send(session, named_file),
+            {("012345600000000", blob_version(named_file)): hashlib.sha256(b"%PDF-1.4 version 2").hexdigest()},
+        )
+        tm.abort()
+        conn.close()
+
 
 # example of annotation content
 """
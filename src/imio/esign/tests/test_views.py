@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""views tests for this package."""
+from datetime import datetime
+from imio.esign.browser.views import FacetedSessionSessionInfoViewlet
+from imio.esign.testing import add_annexes
+from imio.esign.testing import IMIO_ESIGN_INTEGRATION_TESTING
+from imio.esign.utils import add_files_to_session
+from imio.esign.utils import create_session
+from imio.esign.utils import get_request_session
+from imio.esign.utils import get_session_annotation
+from imio.esign.utils import index_session
+from plone.app.testing import setRoles
+from plone.app.testing import TEST_USER_ID
+
+import unittest
+
+
+class TestSessionsListingView(unittest.TestCase):
+
+    layer = IMIO_ESIGN_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+        self.request = self.layer["request"]
+        setRoles(self.portal, TEST_USER_ID, ["Manager"])
+        self.sids = []
+        for i in range(5):
+            sid, session = create_session(
+                [("user1", "user1@sign.com", "User 1", "Position 1")], None, title="Session {}".format(i)
+            )
+            session["last_update"] = datetime(2025, 1, 1 + i)
+            index_session(sid, session)
+            self.sids.append(sid)
+
+    def _view(self, **form):
+        self.request.form.clear()
+        self.request.form.update(form)
+        view = self.portal.restrictedTraverse("@@esign-sessions-listing")
+        view()
+        return view
+
+    def test_batch(self):
+        view = self._view(b_size="2", b_start="2", sort_on="last_update", sort_order="reverse")
+        self.assertEqual([session["id"] for session in view.get_sessions()], [self.sids[2], self.sids[1]])
+        self.assertEqual(view.batch.sequence_length, 5)
+        self.assertEqual(view.batch.pagenumber, 2)
+        self.assertIn("sort_on=last_update", view.get_sort_url("last_update"))
+        self.assertNotIn("sort_order", view.get_sort_url("last_update"))
+        self.assertNotIn("sort_order", view.get_sort_url("state"))
+        self.assertEqual(view.get_states(), [("draft", 5)])
+        self.assertIn("sort_order=reverse", self._view(sort_on="id").get_sort_url("id"))
+        view = self._view(state="to_sign")
+        self.assertEqual(view.get_sessions(), [])
+
+    def test_row_cache(self):
+        self.assertIn("Session 0", self._view().render_table())
+        session = get_session_annotation()["sessions"][self.sids[0]]
+        # a row is rendered again only when its session is updated
+        session["title"] = "Renamed"
+        self.assertNotIn("Renamed", self._view().render_table())
+        session["last_update"] = datetime(2025, 2, 1)
+        index_session(self.sids[0], session)
+        self.assertIn("Renamed", self._view().render_table())
+
+
+class TestSessionFilesView(unittest.TestCase):
+
+    layer = IMIO_ESIGN_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+        self.request = self.layer["request"]
+        setRoles(self.portal, TEST_USER_ID, ["Manager"])
+        self.folders, self.uids = add_annexes(self.portal, count=3)
+        signers = [("user1", "user1@sign.com", "User 1", "Position 1")]
+        self.sid, self.session = add_files_to_session(signers, self.uids)
+
+    def _view(self, **form):
+        self.request.form.clear()
+        self.request.form.update(form)
+        view = self.portal.restrictedTraverse("@@esign-session-files")
+        view()
+        return view
+
+    def test_session_files(self):
+        view = self._view(session_id=str(self.sid))
+        self.assertEqual(len(view.files), 3)
+        ctx, obj = view.files[0]
+        self.assertEqual(ctx.UID, self.folders[0].UID())
+        self.assertEqual(obj.UID, self.uids[0])
+        link = view.get_file_link(ctx, obj)
+        self.assertIn(">Folder 0</span></a> / ", link)
+        self.assertIn("href='{}/@@download'".format(obj.getURL()), link)
+        self.assertIn(">Annex 0</span></a>", link)
+        view = self._view(session_id=str(self.sid), b_start="2", b_size="2")
+        self.assertEqual([obj.UID for ctx, obj in view.files], self.uids[2:])
+        self.assertEqual(view.batch.sequence_length, 3)
+        self.assertEqual(self._view(session_id="unknown").files, [])
+
+
+class TestFacetedSessionInfoViewlet(unittest.TestCase):
+
+    layer = IMIO_ESIGN_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+        self.request = self.layer["request"]
+        setRoles(self.portal, TEST_USER_ID, ["Manager"])
+        self.sid, self.session = create_session(
+            [("user1", "user1@sign.com", "User 1", "Position 1")], None, title="Session title"
+        )
+
+    def _render(self, session_id):
+        self.request.form.clear()
+        self.request.form["esign_session_id[]"] = session_id
+        viewlet = FacetedSessionSessionInfoViewlet(self.portal, self.request, None, None)
+        viewlet.update()
+        return viewlet.render()
+
+    def test_render(self):
+        html = self._render(str(self.sid))
+        self.assertIn("Session title", html)
+        self.assertIn("Position 1", html)
+        self.assertIs(get_request_session(str(self.sid), self.request), self.session)
+        self.assertNotIn("Session title", self._render("unknown"))
+        # the rendering is cached until the session is updated
+        self.session["title"] = "Renamed"
+        self.assertNotIn("Renamed", self._render(str(self.sid)))
+        self.session["last_update"] = datetime(2025, 2, 1)
+        index_session(self.sid, self.session)
+        self.assertIn("Renamed", self._render(str(self.sid)))
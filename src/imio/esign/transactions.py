@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Helpers to work on the esign storage outside a user request, with short transactions."""
+from contextlib import contextmanager
+from imio.esign.utils import get_session_annotation
+from Testing.makerequest import makerequest
+from ZODB.POSException import ConflictError
+from zope.component.hooks import getSite
+from zope.component.hooks import setSite
+
+import transaction
+
+
+COMMIT_ATTEMPTS = 3
+
+
+def in_transaction(tm, func, *args):
+    """Call func(annot, *args) in a new committed transaction, retried on conflict.
+
+    :param tm: transaction manager
+    :param func: function receiving the esign annotation and args
+    :return: func result
+    """
+    for attempt in range(COMMIT_ATTEMPTS):
+        tm.begin()
+        try:
+            result = func(get_session_annotation(), *args)
+            tm.commit()
+            return result
+        except ConflictError:
+            tm.abort()
+            if attempt == COMMIT_ATTEMPTS - 1:
+                raise
+
+
+@contextmanager
+def site_connection(db, portal_path):
+    """Open a database connection with its own transaction manager, and set the portal as site.
+
+    The application is wrapped in a fake request, as expected by content events handlers.
+
+    :param db: ZODB database
+    :param portal_path: portal physical path
+    :return: the transaction manager
+    """
+    tm = transaction.TransactionManager()
+    conn = db.open(transaction_manager=tm)
+    old_site = getSite()
+    try:
+        setSite(makerequest(conn.root()["Application"]).unrestrictedTraverse(portal_path))
+        yield tm
+    finally:
+        setSite(old_site)
+        tm.abort()
+        conn.close()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+from BTrees.Length import Length
+from BTrees.OOBTree import OOTreeSet
+from imio.esign.interfaces import IEsignContext
+from imio.esign.interfaces import IEsignFile
+from imio.esign.storage import new_session_storage
+from imio.esign.storage import Session
+from imio.esign.storage import SessionFile
+from imio.esign.storage import SessionFiles
+from imio.esign.utils import get_readonly_session_annotation
+from imio.esign.utils import index_session
+from imio.esign.utils import register_app_session_id
+from imio.helpers.content import uuidsToObjects
+from persistent.list import PersistentList
+from plone import api
+from zope.annotation import IAnnotations
+from zope.interface import alsoProvides
+
+import logging
+
+
+logger = logging.getLogger("imio.esign")
+
+
+def migrate_session_storage(portal=None):
+    """Convert the esign sessions annotation from its first format to the current storage.
+
+    The first format is a PersistentMapping with an int "numbering" and "sessions" as a mapping of session dicts,
+    whose files are dicts in a list. Sessions keep their ids and are indexed, and sessions already sent get their
+    app session id registered. An annotation already in the current format is left unchanged.
+
+    :param portal: portal, the current one by default
+    :return: the number of converted sessions, or None if nothing was converted
+    """
+    if not portal:
+        portal = api.portal.get()
+    annotations = IAnnotations(portal)
+    old = annotations.get("imio.esign")
+    if old is None or isinstance(old.get("numbering"), Length):
+        return None
+    annot = new_session_storage()
+    annot["numbering"].set(old.get("numbering", 0))
+    for session_id, values in sorted(old.get("sessions", {}).items()):
+        files = SessionFiles()
+        for fdic in values.get("files", ()):
+            if fdic["uid"] in files:
+                logger.error("File UID %s is twice in session %s, only keeping the first one", fdic["uid"], session_id)
+                continue
+            files.append(
+                SessionFile(
+                    uid=fdic["uid"],
+                    context_uid=fdic["context_uid"],
+                    filename=fdic["filename"],
+                    scan_id=fdic["scan_id"],
+                    title=fdic["title"],
+                )
+            )
+            annot["uids"][fdic["uid"]] = session_id
+            if fdic["context_uid"] not in annot["c_uids"]:
+                annot["c_uids"][fdic["context_uid"]] = OOTreeSet()
+            annot["c_uids"][fdic["context_uid"]].insert(fdic["uid"])
+        fields = {key: value for key, value in values.items() if key in Session._fields}
+        fields.update(
+            {
+                "discriminators": tuple(values.get("discriminators") or ()),
+                "files": files,
+                "signers": PersistentList([dict(signer) for signer in values.get("signers", ())]),
+            }
+        )
+        session = Session(**fields)
+        annot["sessions"][session_id] = session
+        annot["count"].change(1)
+        if session["state"] != "draft":
+            register_app_session_id(session_id, annot=annot)
+        index_session(session_id, session, annot=annot)
+    annotations["imio.esign"] = annot
+    logger.info("Converted %s esign sessions", annot["count"]())
+    return annot["count"]()
+
+
+def upgrade_to_1001(context):
+    """Convert the esign sessions annotation to the current storage."""
+    migrate_session_storage()
+
+
+def upgrade_to_1002(context):
+    """Add the esign_session_ids catalog index and index the files of the sessions and their contexts."""
+    context.runImportStepFromProfile("profile-imio.esign:default", "catalog")
+    annot = get_readonly_session_annotation()
+    for uids, interface in ((annot["uids"].keys(), IEsignFile), (annot["c_uids"].keys(), IEsignContext)):
+        for obj in uuidsToObjects(uuids=[uid for uid in uids if uid], unrestricted=True):
+            alsoProvides(obj, interface)
+            obj.reindexObject(idxs=["esign_session_ids"])
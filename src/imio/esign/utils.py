@@ -1,25 +1,56 @@
 # -*- coding: utf-8 -*-
+from Acquisition import aq_inner
+from Acquisition import aq_parent
+from BTrees.IIBTree import IISet
+from BTrees.IIBTree import IITreeSet
+from BTrees.IIBTree import intersection
+from BTrees.IIBTree import multiunion
+from BTrees.OOBTree import OOTreeSet
 from datetime import datetime
 from imio.esign import E_SIGN_ROOT_URL
+from imio.esign.http_client import get_http_session
+from imio.esign.http_client import get_timeout
 from imio.esign.interfaces import IContextUidProvider
+from imio.esign.interfaces import IEsignContext
+from imio.esign.interfaces import IEsignFile
+from imio.esign.storage import EmptySessionStorage
+from imio.esign.storage import new_session_storage
+from imio.esign.storage import Session
+from imio.esign.storage import SessionFile
+from imio.esign.streaming import blob_version
+from imio.esign.streaming import detach_blob_file
+from imio.esign.streaming import MultipartStream
+from imio.helpers.content import uuidsToCatalogBrains
 from imio.helpers.content import uuidsToObjects
-from imio.helpers.content import uuidToObject
-from imio.helpers.transmogrifier import get_correct_id
+from itertools import islice
 from os import path
 from persistent.list import PersistentList
-from persistent.mapping import PersistentMapping
 from plone import api
 from plone.api.validation import mutually_exclusive_parameters
+from plone.memoize.request import cache as request_cache
+from plone.uuid.interfaces import IUUID
 from zope.annotation import IAnnotations
 from zope.component import getAdapter
+from zope.interface import alsoProvides
 
 import json
 import logging
-import requests
+import os
 
 
 logger = logging.getLogger("imio.esign")
+SESSION_ID_MAX = 99999999
+SESSION_IDS_BLOCK = 10
 SESSION_URL = "imio/esign/v1/luxtrust/sessions"
+SESSIONS_SORT_ON = ("id", "last_update", "state")
+
+
+class BatchItems(list):
+    """Items of a batch, giving the length of the whole sequence to a Batch, as catalog results do."""
+
+    def __init__(self, items, actual_result_count):
+        super(BatchItems, self).__init__(items)
+        self.actual_result_count = actual_result_count
 
 
 def add_files_to_session(signers, files_uids, seal=None, acroform=True, session_id=None, title=None, discriminators=()):
@@ -47,79 +78,54 @@ def add_files_to_session(signers, files_uids, seal=None, acroform=True, session_
         session_id, session = create_session(
             signers, seal, acroform=acroform, title=title, annot=annot, discriminators=discriminators
         )
-    existing_files = [path.splitext(f["filename"])[0] for f in session["files"]]
+    # resolve all files in one catalog query
+    brains = {brain.UID: brain for brain in uuidsToCatalogBrains(uuids=list(files_uids), unrestricted=True)}
+    # context uid -> context, or None if it is not the loaded parent of an annex
+    contexts = {}
     for uid in files_uids:
-        annex = uuidToObject(uuid=uid, unrestricted=True)
+        if uid in session["files"]:
+            # already added
+            continue
+        if uid not in brains:
+            logger.error("File UID %s not found in catalog.", uid)
+            continue
+        brain = brains[uid]
+        # the title is read from the brain, scan_id and the file are not catalog metadata and need the annex
+        annex = brain._unrestrictedGetObject()
         context_uid_provider = getAdapter(annex, IContextUidProvider)
         context_uid = context_uid_provider.get_context_uid()
         filename, ext = path.splitext(annex.file.filename or "no_filename.pdf")
-        new_filename = get_correct_id(existing_files, filename)
+        new_filename = session["files"].get_unique_stem(filename)
         session["files"].append(
-            {
-                "scan_id": annex.scan_id,
-                "filename": new_filename + ext,
-                "title": annex.title or "no_title",
-                "uid": uid,
-                "context_uid": context_uid,
-            }
+            SessionFile(
+                uid=uid,
+                context_uid=context_uid,
+                filename=new_filename + ext,
+                scan_id=annex.scan_id,
+                title=brain.Title or "no_title",
+            )
         )
-        existing_files.append(new_filename)
         annot["uids"][uid] = session_id
-        annot["c_uids"].setdefault(context_uid, PersistentList()).append(uid)
-    if session["client_id"] is None:
+        if context_uid not in annot["c_uids"]:
+            annot["c_uids"][context_uid] = OOTreeSet()
+        annot["c_uids"][context_uid].insert(uid)
+        _reindex_object_session_ids(annex, interface=IEsignFile)
+        parent = aq_parent(aq_inner(annex))
+        if context_uid is not None and IUUID(parent, None) == context_uid:
+            contexts[context_uid] = parent
+        else:
+            contexts.setdefault(context_uid, None)
+    for context in contexts.values():
+        if context is not None:
+            _reindex_object_session_ids(context, interface=IEsignContext)
+    _reindex_session_ids([uid for uid, context in contexts.items() if context is None], interface=IEsignContext)
+    if session["client_id"] is None and session["files"]:
         session["client_id"] = session["files"][0]["scan_id"][:7]
     session["last_update"] = datetime.now()
+    index_session(session_id, session, annot=annot)
     return session_id, session
 
 
-def create_external_session(session_id, b64_cred=None, esign_root_url=None):
-    """Create a session with the given signers and files.
-
-    :param session_id: internal session id
-    :param b64_cred: base64 encoded credentials for authentication
-    :param esign_root_url: the root URL for the e-sign service, if not provided it will use the default E_SIGN_ROOT_URL
-    :return: session information
-    """
-    session_url = get_esign_session_url(esign_root_url)
-    annot = get_session_annotation()
-    session = annot["sessions"].get(session_id)
-    if not session:
-        logger.error("Session with id %s not found.", session_id)
-        return None
-    files_uids = [fdic["uid"] for fdic in session["files"]]
-    files = get_files_from_uids(files_uids)
-    # app_session_id = int("{}{:05d}".format(session["client_id"], session_id))
-    # TODO temporary value while waiting for fastapi update
-    app_session_id = 1000 + session_id
-    portal = api.portal.get()
-    data_payload = {
-        "commonData": {
-            "endpointUrl": portal.absolute_url() + "/@external_session_feedback",
-            "documentData": [{"filename": filename, "uniqueCode": unique_code} for unique_code, filename, _ in files],
-            "imioAppSessionId": app_session_id,
-        }
-    }
-
-    signers = [fdic["email"] for fdic in session["signers"]]
-    data_payload["signData"] = {"users": list(signers), "acroform": session["acroform"]}
-
-    if session["seal"] is not None:
-        data_payload["sealData"] = {"sealCode": session["seal"]}
-
-    files_payload = [("files", (filename, file_content)) for _, filename, file_content in files]
-
-    # Headers avec autorisation
-    headers = {"accept": "application/json"}
-    if b64_cred:
-        headers["Authorization"] = "Basic {}".format(b64_cred)
-
-    logger.info(data_payload)
-    ret = post_request(session_url, data={"data": json.dumps(data_payload)}, headers=headers, files=files_payload)
-    logger.info("Response: %s", ret.text)
-    # {"message":"Request received in the expected format. Session is being created in background."}
-    return ret
-
-
 def create_session(signers, seal, acroform=True, title=None, annot=None, discriminators=()):
     """Create a session with the given signers and seal.
 
@@ -133,34 +139,31 @@ def create_session(signers, seal, acroform=True, title=None, annot=None, discrim
     """
     if not annot:
         annot = get_session_annotation()
-    sessions = annot.setdefault("sessions", PersistentMapping())
-    session_id = annot["numbering"]
-    annot["numbering"] += 1
-
-    sessions[session_id] = {
-        "acroform": acroform,
-        "client_id": None,
-        "discriminators": discriminators,
-        "files": PersistentList(),
-        "last_update": datetime.now(),
-        "seal": seal,
-        "sign_url": None,
-        "signers": PersistentList(
+    sessions = annot["sessions"]
+    session_id = _get_new_session_id(annot)
+    annot["count"].change(1)
+
+    sessions[session_id] = Session(
+        acroform=acroform,
+        discriminators=discriminators,
+        last_update=datetime.now(),
+        seal=seal,
+        signers=PersistentList(
             [
                 {"userid": userid, "email": email, "fullname": fullname, "position": position, "status": ""}
                 for userid, email, fullname, position in signers
             ]
         ),
-        "state": "draft",
-        "title": title,
-    }
+        title=title,
+    )
+    index_session(session_id, sessions[session_id], annot=annot)
     return session_id, sessions[session_id]
 
 
 def discriminate_sessions(signers, seal, acroform, discriminators=(), annot=None):
-    """Discriminate sessions based on seal value and signers in the same order.
+    """Discriminate draft sessions based on seal value and signers in the same order.
 
-    :param signers: a list of signers, each is a tuple with userid and email
+    :param signers: a list of signers, each is a quartet with userid, email, fullname and position text
     :param seal: a seal code, if any
     :param acroform: boolean value indicating if acroform is used
     :param discriminators: optional list of string discriminators
@@ -169,27 +172,24 @@ def discriminate_sessions(signers, seal, acroform, discriminators=(), annot=None
     """
     if not annot:
         annot = get_session_annotation()
-    sessions = annot.get("sessions", {})
-
-    for session_id, session in sessions.items():
-        if session.get("seal") != seal:
-            continue
-        if session.get("acroform") != acroform:
-            continue
-        session_signers = session.get("signers", [])
-        if len(signers) != len(session_signers):
-            continue
+    key = get_discrimination_key(
+        [(userid, email) for userid, email, _, _ in signers], seal, acroform, discriminators=discriminators
+    )
+    for session_id in _iter_pairs_index_values(annot["discriminations"], key):
+        return session_id, annot["sessions"][session_id]
+    return None, None
 
-        if set(discriminators) != set(session.get("discriminators", ())):
-            continue
 
-        signers_match = all(
-            (userid, email) == (s["userid"], s["email"]) for (userid, email, _, _), s in zip(signers, session_signers)
-        )
-        if signers_match:
-            return session_id, session
+def get_discrimination_key(signers, seal, acroform, discriminators=()):
+    """Get the key used to index draft sessions in the discriminations index.
 
-    return None, None
+    :param signers: a list of signers, each is a tuple with userid and email
+    :param seal: a seal code, if any
+    :param acroform: boolean value indicating if acroform is used
+    :param discriminators: optional list of string discriminators, order does not matter
+    :return: a string key
+    """
+    return json.dumps([seal, acroform, [[userid, email] for userid, email in signers], sorted(set(discriminators))])
 
 
 def get_esign_session_url(esign_root_url):
@@ -200,11 +200,104 @@ def get_esign_session_url(esign_root_url):
         return "{}/{}".format(E_SIGN_ROOT_URL, SESSION_URL)
 
 
+def get_esign_settings(b64_cred=None, esign_root_url=None):
+    """Get the credentials and the root URL used to call the esign service.
+
+    Values that are not given are read from the IMIO_ESIGN_B64_CRED and IMIO_ESIGN_ROOT_URL environment variables,
+    the root URL defaulting to E_SIGN_ROOT_URL. Sessions sent or retrieved in the background use them, so that
+    credentials are never stored.
+
+    :param b64_cred: base64 encoded credentials for authentication
+    :param esign_root_url: the root URL for the e-sign service
+    :return: (b64_cred, esign_root_url)
+    """
+    return (
+        b64_cred or os.getenv("IMIO_ESIGN_B64_CRED") or None,
+        esign_root_url or os.getenv("IMIO_ESIGN_ROOT_URL") or E_SIGN_ROOT_URL,
+    )
+
+
+def get_external_session_request(session_id, b64_cred=None, esign_root_url=None, endpoint_url=None):
+    """Get the request creating the external session.
+
+    Committed files blobs are read from the filesystem when the body is sent, so it can be sent after the end
+    of the transaction. The app session id is sent as Idempotency-Key header, so that the esign service creates the
+    session only once when its request is sent again.
+
+    :param session_id: internal session id
+    :param b64_cred: base64 encoded credentials for authentication, if not provided the configured ones are used
+    :param esign_root_url: the root URL for the e-sign service, if not provided the configured one is used
+    :param endpoint_url: the feedback endpoint URL, if not provided it is built from the portal URL
+    :return: (url, body, headers) to post or None if the session is not found
+    """
+    b64_cred, esign_root_url = get_esign_settings(b64_cred=b64_cred, esign_root_url=esign_root_url)
+    session_url = get_esign_session_url(esign_root_url)
+    annot = get_readonly_session_annotation()
+    session = annot["sessions"].get(session_id)
+    if not session:
+        logger.error("Session with id %s not found.", session_id)
+        return None
+    files_uids = [fdic["uid"] for fdic in session["files"]]
+    files = get_files_from_uids(files_uids)
+    app_session_id = session["app_session_id"] or _new_app_session_id(session_id, session)
+    if not endpoint_url:
+        endpoint_url = get_feedback_endpoint_url()
+    data_payload = {
+        "commonData": {
+            "endpointUrl": endpoint_url,
+            "documentData": [{"filename": filename, "uniqueCode": unique_code} for unique_code, filename, _ in files],
+            "imioAppSessionId": app_session_id,
+        }
+    }
+
+    signers = [fdic["email"] for fdic in session["signers"]]
+    data_payload["signData"] = {"users": list(signers), "acroform": session["acroform"]}
+
+    if session["seal"] is not None:
+        data_payload["sealData"] = {"sealCode": session["seal"]}
+
+    # files are read by chunks, and hashed if changed, while the request body is sent
+    session_files = {session_file["scan_id"]: session_file for session_file in session["files"]}
+    files_parts = []
+    for unique_code, filename, named_file in files:
+        session_file = session_files.get(unique_code)
+        files_parts.append(
+            (
+                "files",
+                filename,
+                detach_blob_file(named_file),
+                (unique_code, blob_version(named_file)),
+                session_file and get_stored_file_hash(session_file, named_file),
+            )
+        )
+    body = MultipartStream(fields=[("data", json.dumps(data_payload))], files=files_parts)
+
+    # Headers avec autorisation
+    headers = {
+        "accept": "application/json",
+        "Content-Type": body.content_type,
+        "Idempotency-Key": str(app_session_id),
+    }
+    if b64_cred:
+        headers["Authorization"] = "Basic {}".format(b64_cred)
+
+    logger.info(data_payload)
+    return session_url, body, headers
+
+
+def get_feedback_endpoint_url(portal=None):
+    """Get the URL of the service receiving the external sessions feedback."""
+    if not portal:
+        portal = api.portal.get()
+    return portal.absolute_url() + "/@external_session_feedback"
+
+
 def get_files_from_uids(uids):
     """Get files from uids.
 
     :param uids: uids
-    :return: list of triplets (scan_id, filename, file_content) for each coresponding object
+    :return: list of triplets (scan_id, filename, file) for each coresponding object, file being the annex
+             named file, whose content is not loaded
     """
     annexes = uuidsToObjects(uuids=uids, unrestricted=True)
 
@@ -220,41 +313,235 @@ def get_files_from_uids(uids):
             continue
         else:
             filename = annex.file.filename or "no_filename"
-            file_content = annex.file.data
 
-        files_data.append((scan_id, filename, file_content))
+        files_data.append((scan_id, filename, annex.file))
 
     return files_data
 
 
+def get_readonly_session_annotation(portal=None):
+    """Get the e-sign session annotation to read it, without creating it, so that reading never writes.
+
+    :param portal: portal, the current one by default
+    :return: the stored annotation or an empty read only view if nothing has been stored yet
+    """
+    if not portal:
+        portal = api.portal.get()
+    annot = IAnnotations(portal).get("imio.esign")
+    return EmptySessionStorage() if annot is None else annot
+
+
+@request_cache(get_key=lambda fun, session_id, request: str(session_id), get_request="request")
+def get_request_session(session_id, request):
+    """Get a stored session, looked up once per request.
+
+    :param session_id: session id, as int or string
+    :param request: current request, storing the looked up sessions
+    :return: session or None if not found
+    """
+    try:
+        session_id = int(session_id)
+    except (TypeError, ValueError):
+        return None
+    return get_readonly_session_annotation()["sessions"].get(session_id)
+
+
 def get_session_annotation(portal=None):
     """Get the e-sign session annotation."""
     if not portal:
         portal = api.portal.get()
     annotations = IAnnotations(portal)
     if "imio.esign" not in annotations:
-        annotations["imio.esign"] = PersistentMapping(
-            {
-                "numbering": 0,
-                "sessions": PersistentMapping(),
-                "uids": PersistentMapping(),
-                "c_uids": PersistentMapping(),
-            }
-        )
+        annotations["imio.esign"] = new_session_storage()
     return annotations["imio.esign"]
 
 
+def get_session_id_from_app_session_id(app_session_id, annot=None):
+    """Get the internal session id of an external session id, as received in feedbacks.
+
+    :param app_session_id: the session id in the esign service, as int or string
+    :param annot: esign annotation, if not provided it will be fetched
+    :return: session id or None if not found
+    """
+    if not annot:
+        annot = get_readonly_session_annotation()
+    return annot["app_session_ids"].get(str(app_session_id))
+
+
+def get_session_ids(states=None, start=None, end=None, signer=None, discriminator=None, annot=None):
+    """Get the ids of the sessions in the given states and last updated in the given range, from the indexes.
+
+    :param states: list of states, all states if None
+    :param start: minimum last update datetime, included
+    :param end: maximum last update datetime, included
+    :param signer: only get sessions signed by this signer userid or email
+    :param discriminator: only get sessions with this discriminator
+    :param annot: esign annotation, if not provided it will be fetched
+    :return: IISet of session ids
+    """
+    if not annot:
+        annot = get_readonly_session_annotation()
+    result = None
+    if states is not None:
+        result = multiunion([annot["states"][state] for state in states if state in annot["states"]])
+    if start is not None or end is not None:
+        pairs = annot["last_updates"].keys(
+            min=None if start is None else (start, 0), max=None if end is None else (end, SESSION_ID_MAX)
+        )
+        updated = IISet([session_id for last_update, session_id in pairs])
+        result = updated if result is None else intersection(result, updated)
+    for index, key in (("signers", signer), ("discriminators", discriminator)):
+        if key is not None:
+            selected = IISet(list(_iter_pairs_index_values(annot[index], key)))
+            result = selected if result is None else intersection(result, selected)
+    if result is None:
+        result = IISet(annot["sessions"].keys())
+    return result
+
+
+def get_sessions_batch(
+    b_start=0,
+    b_size=20,
+    sort_on="last_update",
+    reverse=False,
+    state=None,
+    start=None,
+    end=None,
+    signer=None,
+    discriminator=None,
+    annot=None,
+):
+    """Get a batch of sessions, sorted and optionally filtered, as in get_session_ids.
+
+    Session ids are iterated from the sessions and indexes keys, so only the sessions of the batch are loaded.
+    A filtered selection is sorted from the indexed values of its sessions when it is small compared to the index,
+    which would otherwise be walked until the batch is filled.
+
+    :param b_start: index of the first session of the batch
+    :param b_size: batch size
+    :param sort_on: "last_update", "id" or "state". Session ids are reserved by blocks per connection, so sorting
+        on "id" only gives the creation order of the sessions created by a same connection
+    :param reverse: reverse sort order
+    :param state: only get sessions in this state
+    :param start: minimum last update datetime, included
+    :param end: maximum last update datetime, included
+    :param signer: only get sessions signed by this signer userid or email
+    :param discriminator: only get sessions with this discriminator
+    :param annot: esign annotation, if not provided it will be fetched
+    :return: (number of sessions, list of (session id, session) of the batch)
+    """
+    if sort_on not in SESSIONS_SORT_ON:
+        raise ValueError("Cannot sort sessions on {}".format(sort_on))
+    if not annot:
+        annot = get_readonly_session_annotation()
+    sessions = annot["sessions"]
+    if start is not None or end is not None or signer is not None or discriminator is not None:
+        selection = get_session_ids(
+            states=[state] if state else None,
+            start=start,
+            end=end,
+            signer=signer,
+            discriminator=discriminator,
+            annot=annot,
+        )
+        total = len(selection)
+    elif state:
+        selection = annot["states"].get(state, IITreeSet())
+        total = len(selection)
+    else:
+        selection = None
+        total = annot["count"]()
+    if sort_on == "id" or (sort_on == "state" and state):
+        # sessions of a same state are sorted on id
+        session_ids = _iter_keys(sessions if selection is None else selection, reverse)
+    elif selection is not None and total * total < (b_start + b_size) * annot["count"]():
+        # walking the index would visit about (b_start + b_size) * len(index) / total sessions
+        session_ids = _iter_sorted_selection(annot, 0 if sort_on == "state" else 1, reverse, selection)
+    elif sort_on == "state":
+        session_ids = _iter_index_values(annot["states"], reverse, selection)
+    else:
+        session_ids = (
+            session_id
+            for last_update, session_id in _iter_keys(annot["last_updates"], reverse)
+            if selection is None or session_id in selection
+        )
+    return total, [(session_id, sessions[session_id]) for session_id in islice(session_ids, b_start, b_start + b_size)]
+
+
+def get_signed_file_url(esign_root_url, app_session_id, unique_code):
+    """Get the URL of a signed file in the esign service.
+
+    :param esign_root_url: the root URL for the e-sign service, if not provided it will use the default E_SIGN_ROOT_URL
+    :param app_session_id: the session id in the esign service
+    :param unique_code: the file unique code, its scan_id
+    :return: URL
+    """
+    return "{}/{}/files/{}".format(get_esign_session_url(esign_root_url), app_session_id, unique_code)
+
+
+def get_stored_file_hash(session_file, named_file):
+    """Get the SHA-256 digest stored in a session file, if it was computed from the current version of the file.
+
+    :param session_file: a session file
+    :param named_file: its named (blob) file
+    :return: hex digest or None if unknown
+    """
+    version = blob_version(named_file)
+    if version is None or session_file["blob_version"] != version:
+        return None
+    return session_file["sha256"]
+
+
+def index_session(session_id, session, annot=None):
+    """Update the sessions indexes for the given session, to be called after each change of a session.
+
+    Only draft sessions can be discriminated. Sessions are also indexed by state, last update, signers and
+    discriminators, and each call is counted as a sessions modification. A session without last update is indexed
+    with datetime.min, so that it is listed first when sorting on last update.
+
+    :param session_id: session id
+    :param session: session information
+    :param annot: esign annotation, if not provided it will be fetched
+    """
+    if not annot:
+        annot = get_session_annotation()
+    annot["modifications"].change(1)
+    discriminations = annot["discriminations"]
+    key = _session_discrimination_key(session)
+    if session["state"] == "draft":
+        _add_to_pairs_index(discriminations, key, session_id)
+    else:
+        _discard_from_pairs_index(discriminations, key, session_id)
+    indexed = annot["indexed"].get(session_id)
+    values = (session["state"], session["last_update"] or datetime.min)
+    if indexed == values:
+        return
+    if indexed is not None:
+        _discard_from_index(annot["states"], indexed[0], session_id, keep_empty=True)
+        _discard_from_pairs_index(annot["last_updates"], indexed[1], session_id)
+    else:
+        # signers and discriminators are set at the session creation
+        for signer_key in _session_signer_keys(session):
+            _add_to_pairs_index(annot["signers"], signer_key, session_id)
+        for discriminator in session["discriminators"] or ():
+            _add_to_pairs_index(annot["discriminators"], discriminator, session_id)
+    _add_to_index(annot["states"], values[0], session_id)
+    _add_to_pairs_index(annot["last_updates"], values[1], session_id)
+    annot["indexed"][session_id] = values
+
+
 @mutually_exclusive_parameters("json", "files")
-def post_request(url, data=None, json=None, headers=None, files=None):
-    """Post data to url.
+def post_request(url, data=None, json=None, headers=None, files=None, timeout=None):
+    """Post data to url, with the pooled http client.
 
     :param url: the url to post to
-    :param data: a data struct to consider
+    :param data: a data struct to consider, or a file like object (as a MultipartStream) streamed as body
     :param json: a json serializable object
     :param headers: headers to use
     :param files: files to upload (dict or list of tuples)
+    :param timeout: (connect, read) timeout, if not provided the configured one is used
     """
-    kwargs = {}
+    kwargs = {"timeout": timeout or get_timeout()}
 
     if files:
         kwargs["files"] = files
@@ -270,15 +557,56 @@ def post_request(url, data=None, json=None, headers=None, files=None):
     else:
         kwargs["data"] = data
 
-    with requests.post(url, **kwargs) as response:
+    with get_http_session().post(url, **kwargs) as response:
         if response.status_code != 200:
-            # if files:
-            # del kwargs["files"]  # remove files from kwargs to avoid sending them in the log
-            kwargs["files"] = [(tup[0], (tup[1][0], len(tup[1][1]))) for tup in kwargs["files"]]
+            if files:
+                # only log files sizes
+                kwargs["files"] = [(tup[0], (tup[1][0], len(tup[1][1]))) for tup in kwargs["files"]]
             logger.error("Error while posting data '%s' to '%s': %s" % (kwargs, url, response.text))
         return response
 
 
+def register_app_session_id(session_id, annot=None):
+    """Register the id of the session in the esign service, in the session and the app_session_ids index.
+
+    Setting it is counted as a sessions modification.
+
+    :param session_id: session id
+    :param annot: esign annotation, if not provided it will be fetched
+    :return: the app session id
+    """
+    if not annot:
+        annot = get_session_annotation()
+    session = annot["sessions"][session_id]
+    if session["app_session_id"] is None:
+        session["app_session_id"] = _new_app_session_id(session_id, session)
+        annot["modifications"].change(1)
+    annot["app_session_ids"][str(session["app_session_id"])] = session_id
+    return session["app_session_id"]
+
+
+def register_files_hashes(session_id, hashes, annot=None):
+    """Store in the session files the SHA-256 digests of their content sent to the esign service, with the version
+    of the blob they were computed from.
+
+    :param session_id: session id
+    :param hashes: dict (file unique code, blob version) -> hex digest, as computed by MultipartStream while sending
+    :param annot: esign annotation, if not provided it will be fetched
+    """
+    if not hashes:
+        return
+    if not annot:
+        annot = get_session_annotation()
+    session = annot["sessions"].get(session_id)
+    if not session:
+        return
+    session_files = {session_file["scan_id"]: session_file for session_file in session["files"]}
+    for (unique_code, version), sha256 in hashes.items():
+        session_file = session_files.get(unique_code)
+        if session_file is not None and (session_file["sha256"], session_file["blob_version"]) != (sha256, version):
+            session["files"].update_file(session_file["uid"], {"blob_version": version, "sha256": sha256})
+
+
 def remove_context_from_session(context_uids):
     """Remove all files from a session that are linked to the given context UIDs.
 
@@ -302,6 +630,7 @@ def remove_files_from_session(files_uids):
     sessions = annot["sessions"]
     uids = annot["uids"]
     c_uids = annot["c_uids"]
+    reindexed = set()
 
     for uid in files_uids:
         session_id = uids.get(uid)
@@ -309,33 +638,29 @@ def remove_files_from_session(files_uids):
             logger.error("No session found for file UID %s", uid)
             continue
         del uids[uid]
+        reindexed.add(uid)
         if session_id not in sessions:
             logger.error("Session %s not found", session_id)
             continue
         session = sessions[session_id]
-        i = 0
-        context_uid = None
-        for j, dic in enumerate(session["files"]):
-            if dic["uid"] == uid:
-                i = j
-                context_uid = dic["context_uid"]
-                break
-        else:
+        session_file = session["files"].remove(uid)
+        if session_file is None:
             logger.error("File UID %s not found in session %s", uid, session_id)
             continue
 
-        del session["files"][i]
         if not session["files"]:
+            unindex_session(session_id, session, annot=annot)
             del sessions[session_id]
+            annot["count"].change(-1)
         else:
             session["last_update"] = datetime.now()
+            index_session(session_id, session, annot=annot)
 
-        if context_uid in c_uids and uid in c_uids[context_uid]:
-            c_uids[context_uid].remove(uid)
-            if not c_uids[context_uid]:
-                del c_uids[context_uid]
+        _discard_from_index(c_uids, session_file["context_uid"], uid)
+        reindexed.add(session_file["context_uid"])
 
         # logger.info("File UID %s removed from session %s", uid, session_id)
+    _reindex_session_ids(reindexed)
 
 
 def remove_session(session_id):
@@ -353,13 +678,210 @@ def remove_session(session_id):
         return
 
     session = sessions[session_id]
+    reindexed = set()
     for fdic in session["files"]:
         if fdic["uid"] in uids:
             del uids[fdic["uid"]]
-        if fdic["context_uid"] in c_uids and fdic["uid"] in c_uids[fdic["context_uid"]]:
-            c_uids[fdic["context_uid"]].remove(fdic["uid"])
-            if not c_uids[fdic["context_uid"]]:
-                del c_uids[fdic["context_uid"]]
+        _discard_from_index(c_uids, fdic["context_uid"], fdic["uid"])
+        reindexed.update((fdic["uid"], fdic["context_uid"]))
 
+    unindex_session(session_id, session, annot=annot)
     del sessions[session_id]
+    annot["count"].change(-1)
+    _reindex_session_ids(reindexed)
     # logger.info("Session %s removed", session_id)
+
+
+def unindex_session(session_id, session, annot=None):
+    """Remove the given session from the sessions indexes.
+
+    :param session_id: session id
+    :param session: session information
+    :param annot: esign annotation, if not provided it will be fetched
+    """
+    if not annot:
+        annot = get_session_annotation()
+    annot["modifications"].change(1)
+    _discard_from_pairs_index(annot["discriminations"], _session_discrimination_key(session), session_id)
+    indexed = annot["indexed"].get(session_id)
+    if indexed is not None:
+        _discard_from_index(annot["states"], indexed[0], session_id, keep_empty=True)
+        _discard_from_pairs_index(annot["last_updates"], indexed[1], session_id)
+        for signer_key in _session_signer_keys(session):
+            _discard_from_pairs_index(annot["signers"], signer_key, session_id)
+        for discriminator in session["discriminators"] or ():
+            _discard_from_pairs_index(annot["discriminators"], discriminator, session_id)
+        del annot["indexed"][session_id]
+    app_session_id = session["app_session_id"]
+    if app_session_id is not None and annot["app_session_ids"].get(str(app_session_id)) == session_id:
+        del annot["app_session_ids"][str(app_session_id)]
+
+
+def _add_to_index(index, key, value):
+    """Add value to the set stored at key in index, creating the set if needed."""
+    if key not in index:
+        index[key] = IITreeSet()
+    index[key].insert(value)
+
+
+def _add_to_pairs_index(index, key, value):
+    """Add the (key, value) pair to an OOTreeSet index of pairs."""
+    index.insert((key, value))
+
+
+def _discard_from_index(index, key, value, keep_empty=False):
+    """Remove value from the set stored at key in index, deleting the key when the set is empty unless keep_empty."""
+    if key in index and value in index[key]:
+        index[key].remove(value)
+        if not index[key] and not keep_empty:
+            del index[key]
+
+
+def _discard_from_pairs_index(index, key, value):
+    """Remove the (key, value) pair from an OOTreeSet index of pairs."""
+    if (key, value) in index:
+        index.remove((key, value))
+
+
+def _get_new_session_id(annot):
+    """Get a new session id, from the block of sequential ids reserved by the current connection.
+
+    Each connection reserves blocks of SESSION_IDS_BLOCK ids from the "numbering" conflict resolving counter and
+    keeps its current block in a volatile attribute, so that concurrent transactions (threads or ZEO clients) use
+    ids of different blocks and their inserts in the sessions BTree can be merged by conflict resolution.
+    Connections reserving a block at the same time get the same one: the first committed transaction keeps it, the
+    other one is retried after a ConflictError and the block is dropped as soon as one of its ids is found used.
+    """
+    sessions = annot["sessions"]
+    while True:
+        block = getattr(annot, "_v_session_ids", None)
+        if not block or block[0] >= block[1]:
+            block = _reserve_session_ids(annot)
+        session_id, limit = block
+        annot._v_session_ids = (session_id + 1, limit)
+        if session_id not in sessions:
+            return session_id
+        annot._v_session_ids = None
+
+
+def _iter_index_values(index, reverse=False, selection=None):
+    """Iterate over the ids stored in an index with few keys, as the states index, in the order of its keys then of
+    the ids.
+
+    :param index: OOBTree key -> IITreeSet of ids
+    :param reverse: reverse order
+    :param selection: only iterate over these ids
+    """
+    for key in sorted(index.keys(), reverse=reverse):
+        ids = index[key]
+        if selection is not None:
+            ids = intersection(selection, ids)
+        for value in _iter_keys(ids, reverse):
+            yield value
+
+
+def _iter_keys(tree, reverse=False):
+    """Iterate over the keys of a BTree or a set, without loading them all if not needed.
+
+    In reverse order, each key is looked up as the greatest one before the previous key, so keys must be integers
+    or tuples ending with an integer.
+    """
+    if not reverse:
+        return iter(tree.keys())
+    return _iter_reversed_keys(tree)
+
+
+def _iter_pairs_index_values(index, key):
+    """Iterate over the session ids stored with the given key in an OOTreeSet index of (key, session id) pairs."""
+    for pair_key, session_id in index.keys(min=(key, 0), max=(key, SESSION_ID_MAX)):
+        yield session_id
+
+
+def _iter_reversed_keys(tree):
+    """Iterate over the integer, or ending with an integer, keys of a BTree or a set in reverse order."""
+    if not tree:
+        return
+    key = tree.maxKey()
+    while True:
+        yield key
+        if isinstance(key, tuple):
+            before = key[:-1] + (key[-1] - 1,)
+        else:
+            before = key - 1
+        try:
+            key = tree.maxKey(before)
+        except ValueError:
+            # no key before
+            return
+
+
+def _iter_sorted_selection(annot, position, reverse, selection):
+    """Iterate over selected session ids, sorted on one of their indexed values then on id.
+
+    :param annot: esign annotation
+    :param position: position of the value in the "indexed" values, 0 for the state and 1 for the last update
+    :param reverse: reverse order
+    :param selection: session ids
+    """
+    indexed = annot["indexed"]
+    values = sorted(((indexed[session_id][position], session_id) for session_id in selection), reverse=reverse)
+    for value, session_id in values:
+        yield session_id
+
+
+def _new_app_session_id(session_id, session):
+    """Compute the id of the session in the esign service."""
+    # app_session_id = int("{}{:05d}".format(session["client_id"], session_id))
+    # TODO temporary value while waiting for fastapi update
+    return 1000 + session_id
+
+
+def _reindex_object_session_ids(obj, interface=None):
+    """Reindex the esign_session_ids catalog index of an object.
+
+    :param obj: indexed object
+    :param interface: marker interface provided by the indexed object, added if missing
+    """
+    if interface is not None and not interface.providedBy(obj):
+        alsoProvides(obj, interface)
+    obj.reindexObject(idxs=["esign_session_ids"])
+
+
+def _reindex_session_ids(uids, interface=None):
+    """Reindex the esign_session_ids catalog index of the objects with the given uids.
+
+    :param uids: objects uids
+    :param interface: marker interface provided by the indexed objects, added if missing
+    """
+    uids = [uid for uid in uids if uid]
+    if not uids:
+        return
+    for obj in uuidsToObjects(uuids=uids, unrestricted=True):
+        _reindex_object_session_ids(obj, interface=interface)
+
+
+def _reserve_session_ids(annot):
+    """Reserve a new block of SESSION_IDS_BLOCK session ids for the current connection.
+
+    :param annot: esign annotation
+    :return: (first id, id following the last one) of the block
+    """
+    start = annot["numbering"]()
+    annot["numbering"].change(SESSION_IDS_BLOCK)
+    annot._v_session_ids = (start, start + SESSION_IDS_BLOCK)
+    return annot._v_session_ids
+
+
+def _session_discrimination_key(session):
+    """Get the discrimination key of a stored session."""
+    return get_discrimination_key(
+        [(signer["userid"], signer["email"]) for signer in session["signers"]],
+        session["seal"],
+        session["acroform"],
+        discriminators=session["discriminators"],
+    )
+
+
+def _session_signer_keys(session):
+    """Get the userids and emails of the session signers, as indexed."""
+    return {signer[key] for signer in session["signers"] for key in ("userid", "email") if signer.get(key)}